@@ -241,10 +241,8 @@ def train(num_gestures,ntrials):
                 #learn.. what? tip or something ortogonal to it?                
                 if teach_orth:
                     teach_ortogonal_sign = L.orth_signal(X)#np.zeros([nT,n_neu])
-                    teach_ortogonal = np.zeros([nT,n_neu])
-                    for i in range(n_neu):
-                        teach_ortogonal[:,i] = teach_ortogonal_sign
-                    teach_sign = teach_ortogonal
+                    # same target for all the readouts, solved once
+                    teach_sign = np.broadcast_to(teach_ortogonal_sign[:,None], [nT,n_neu])
                     
                 Y = L.ts2sig(timev, membrane, outputs[0][:,0], outputs[0][:,1], n_neu = 256)
                 
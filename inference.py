@@ -0,0 +1,151 @@
+'''
+ Copyright (C) 2014 - Federico Corradi
+ Copyright (C) 2014 - Juan Pablo Carbajal
+
+ This progrm is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+############### author ##########
+# federico corradi
+# federico@ini.phys.ethz.ch
+# Juan Pablo Carbajal
+# ajuanpi+dev@gmail.com
+#
+# Trained readouts: export and NumPy-only inference
+# ===============================
+from __future__ import division
+import numpy as np
+
+READOUT_VERSION = 1
+
+def kernel_params (kernel):
+    '''
+    Parameters of the feature kernel as a flat dict, e.g. spk2sig.Gaussian(10)
+    gives {"kind": "Gaussian", "sigma": 10}. A dict is returned as it is.
+    '''
+    if kernel is None:
+        return {}
+    if isinstance(kernel, dict):
+        return dict(kernel)
+    params = dict(vars(kernel))
+    params["kind"] = kernel.__class__.__name__
+    return params
+
+def save_readout (filename, W, intercept = 0.0, active = None, kernel = None):
+    '''
+    Saves a trained readout to a small versioned .npz file, only the weights
+    of the active neurons are kept.
+    W -> weights [n_features, k] (e.g. ReadoutW["output"])
+    intercept -> [k] or scalar
+    active -> boolean mask or indices of the active neurons, default the
+              rows with a nonzero weight
+    kernel -> feature kernel (e.g. spk2sig.Gaussian) or a dict of its
+              parameters, see kernel_params
+    '''
+    W = np.asarray(W, dtype=float)
+    W = W.reshape([W.shape[0],-1])
+    if active is None:
+        active = np.any (W != 0, axis=1)
+    active = np.asarray(active)
+    if active.dtype == bool:
+        active = np.where (active)[0]
+    out = {"version": READOUT_VERSION, "n_features": W.shape[0], \
+           "W": W[active], "active": active.astype(np.int64), \
+           "intercept": np.asarray(intercept, dtype=float) * np.ones(W.shape[1])}
+    for name, value in kernel_params(kernel).items():
+        out["kernel_"+name] = np.asarray(value)
+    np.savez (filename, **out)
+
+def load_readout (filename, dtype = np.float64, max_batch = 0):
+    '''
+    Readout saved by save_readout, see Readout for dtype and max_batch.
+    '''
+    f = np.load (filename)
+    if int(f["version"]) != READOUT_VERSION:
+        raise ValueError ("unknown readout version %d in %s" \
+                          % (int(f["version"]), filename))
+    kernel = {}
+    for name in f.files:
+        if name.startswith ("kernel_"):
+            value = f[name]
+            kernel[name[7:]] = value.item() if value.ndim == 0 else value
+    r = Readout (f["W"], f["intercept"], f["active"], int(f["n_features"]), \
+                 kernel, dtype, max_batch)
+    f.close()
+    return r
+
+class Readout:
+    '''
+    Trained linear readout y = x[active] W + intercept, for deployment. It
+    needs only NumPy: every prediction is one GEMM (batch) or GEMV (single
+    frame) into preallocated outputs. The weights are kept zero padded to
+    the full state too, so full frames need no gather of the active neurons.
+    The returned arrays are those buffers, they are overwritten by the next
+    call (copy them to keep them) unless out is given.
+    '''
+    def __init__(self, W, intercept, active, n_features, kernel = None, \
+                 dtype = np.float64, max_batch = 0):
+        '''
+        W -> weights of the active neurons [n_active, k]
+        intercept -> [k]
+        active -> indices of the active neurons
+        n_features -> number of neurons of the full state
+        kernel -> dict of the feature kernel parameters
+        dtype -> of the weights and outputs (float32 halves the memory traffic)
+        max_batch -> rows of the batch output buffer, it grows on demand
+        '''
+        self.dtype      = np.dtype(dtype)
+        self.W          = np.ascontiguousarray (W, dtype=self.dtype)
+        self._W_full    = np.zeros ([n_features, self.W.shape[1]], dtype=self.dtype)
+        self._W_full[active] = self.W
+        self.intercept  = np.asarray(intercept, dtype=self.dtype).ravel()
+        self.active     = np.asarray(active, dtype=np.intp)
+        self.n_features = n_features
+        self.kernel     = kernel if kernel is not None else {}
+        self._frame     = np.empty (self.W.shape[1], dtype=self.dtype)
+        self._batch     = np.empty ([max_batch, self.W.shape[1]], dtype=self.dtype)
+
+    def _weights(self, x):
+        '''
+        x in the dtype of the weights and the weights matching its width,
+        the full state or only the active neurons.
+        '''
+        x = np.asarray(x, dtype=self.dtype)
+        if x.shape[-1] == self.n_features:
+            return x, self._W_full
+        return x, self.W
+
+    def predict(self, x, out = None):
+        '''
+        x -> states [nT, n_features] (or [nT, n_active])
+        out -> [nT, k] output array, default the internal buffer
+        '''
+        x, W = self._weights (x)
+        if out is None:
+            if self._batch.shape[0] < x.shape[0]:
+                self._batch = np.empty ([x.shape[0], self.W.shape[1]], dtype=self.dtype)
+            out = self._batch[:x.shape[0]]
+        np.dot (x, W, out=out)
+        out += self.intercept
+        return out
+
+    def step(self, x):
+        '''
+        Prediction [k] of a single frame x [n_features] (or [n_active]).
+        '''
+        x, W = self._weights (x)
+        np.dot (x, W, out=self._frame)
+        self._frame += self.intercept
+        return self._frame
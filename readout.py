@@ -0,0 +1,1158 @@
+'''
+ Copyright (C) 2014 - Federico Corradi
+ Copyright (C) 2014 - Juan Pablo Carbajal
+
+ This progrm is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+############### author ##########
+# federico corradi
+# federico@ini.phys.ethz.ch
+# Juan Pablo Carbajal
+# ajuanpi+dev@gmail.com
+#
+# Readout statistics and solvers
+# ===============================
+from __future__ import division
+import numpy as np
+from scipy import sparse
+from scipy.linalg import get_blas_funcs, cho_factor, cho_solve, qr, lstsq
+from collections import deque
+import copy
+import warnings
+import inference
+
+def gram (x):
+    '''
+    x.T x as a dense array, x dense or scipy.sparse [nT, Nn].
+    '''
+    if sparse.issparse(x):
+        return x.T.dot(x).toarray()
+    return np.dot (x.T, x)
+
+def project (x, teach_sig):
+    '''
+    x.T teach_sig as a dense array, x dense or scipy.sparse [nT, Nn].
+    '''
+    if sparse.issparse(x):
+        return np.asarray (x.T.dot(teach_sig))
+    return np.dot (x.T, teach_sig)
+
+def target_sums (teach_sig):
+    '''
+    Sum and sum of squares over samples of every target, [n_teach] each.
+    '''
+    teach_sig = np.asarray(teach_sig, dtype=float)
+    teach_sig = teach_sig.reshape([teach_sig.shape[0],-1])
+    return np.sum (teach_sig, axis=0), np.sum (teach_sig**2, axis=0)
+
+def unique_targets (teach_sig, tol = 1e-10, dependent = True):
+    '''
+    Finds identical or linearly dependent target columns, so that only the
+    independent ones are solved. Returns their indices cols and the mixing
+    matrix mix [len(cols), n_teach] with teach_sig = teach_sig[:,cols] mix.
+    A broadcast view (zero column stride, np.broadcast_to) is recognised
+    without looking at the data, identical columns by np.unique and linear
+    dependence by a QR with column pivoting (rank relative to tol).
+    dependent -> False finds only broadcast and identical columns, mix is
+                 then a 0/1 copy of every unique column
+    '''
+    teach_sig = np.asarray(teach_sig)
+    if teach_sig.ndim == 1:
+        return np.array([0]), np.ones([1,1])
+    k = teach_sig.shape[1]
+    if k == 1 or teach_sig.strides[1] == 0:
+        return np.array([0]), np.ones([1,k])
+    # identical columns
+    first, inv = np.unique(teach_sig.T, axis=0, return_index=True, \
+                           return_inverse=True)[1:]
+    inv = np.ravel(inv)
+    if not dependent:
+        order = np.argsort (first)              # keep the column order
+        return first[order], (order[:,None] == inv[None,:]).astype(float)
+    U   = teach_sig[:,first].astype(float)
+    # linearly dependent ones
+    R, piv = qr (U, mode='r', pivoting=True)
+    d   = np.abs(np.diag(R))
+    r   = max(np.sum(d > tol*d[0]), 1) if len(d) and d[0] > 0 else 1
+    sel = np.sort(piv[:r])
+    if r == len(first):
+        mix = np.eye(r)[sel]
+    else:
+        mix = lstsq (U[:,sel], U)[0]
+    order = np.argsort (first[sel])             # keep the column order
+    return first[sel][order], mix[order][:,inv]
+
+def moments (x, teach_sig):
+    '''
+    Sufficient statistics of the regression of teach_sig on x, summed over
+    the nT samples: (x.T x, x.T teach_sig, sum of x, sum of teach_sig,
+    sum of teach_sig**2). x dense or scipy.sparse [nT, Nn].
+    '''
+    sx = np.asarray(x.sum(axis=0)).ravel()
+    return (gram (x), project (x, teach_sig), sx) + target_sums (teach_sig)
+
+class CovAccumulator:
+    '''
+    Running sums of the readout statistics of x [nT, p] against the targets,
+    updated in place: x.T x by symmetric rank-k updates (BLAS syrk) into the
+    upper triangle of a preallocated buffer, or into packed upper-triangle
+    storage (p*(p+1)/2 values, column by column). The dense packed update
+    goes by blocks of columns, its temporary is at most p x block; sparse
+    x builds the sparse product x.T x (its nonzeros) before adding its
+    upper triangle. stats() returns the averages over the samples, the same
+    CovMatrix/ProjTeach/means the readouts keep.
+    Every update/add is a trial. To track drifting data the sums can
+    forget the old trials:
+    forget -> the sums are scaled by forget before every new trial
+              (exponential forgetting, n becomes the effective count)
+    window -> keep only the last window trials, the contribution of every
+              trial is stored and subtracted (downdated) when it leaves
+    dtype -> float64 or float32 (half the memory, sums lose precision)
+    packed -> packed triangle storage
+    block -> columns per GEMM of the packed update (smaller blocks, smaller
+             temporary, slower)
+    '''
+    def __init__(self, n_features, dtype = np.float64, packed = False, \
+                 block = 256, forget = 1.0, window = None):
+        self.n_features = n_features
+        self.dtype  = np.dtype(dtype)
+        self.packed = packed
+        self.block  = block
+        self.forget = forget
+        self.window = window
+        self._syrk  = get_blas_funcs('syrk', dtype=self.dtype)
+        self.reset()
+
+    def reset(self):
+        p = self.n_features
+        if self.packed:
+            self.sxx = np.zeros (p*(p+1)//2, dtype=self.dtype)
+        else:
+            self.sxx = np.zeros ([p,p], dtype=self.dtype, order='F')
+        self.sxy = None       # [p, n_targets], sized by the first targets
+        self.sx  = np.zeros (p)
+        self.sy  = 0
+        self.syy = 0
+        self.n   = 0
+        self._trials = deque()
+
+    def update(self, x, teach_sig):
+        '''
+        Adds the samples (rows) of x and their targets, a trial.
+        x -> [nT, p] dense or scipy.sparse
+        teach_sig -> [nT] or [nT, k]
+        '''
+        if self.forget == 1 and self.window is None:
+            self._update (x, teach_sig)
+        else:
+            self.push (self._trial()._update(x, teach_sig))
+
+    def add(self, C, Z, sx, sy, syy, nT):
+        '''
+        Adds precomputed sums over nT samples (a trial), e.g. from
+        spk2sig.gauss_stats.
+        C -> x.T x, Z -> x.T teach_sig, sx, sy, syy -> sums of x, teach_sig
+        and teach_sig**2
+        '''
+        if self.forget == 1 and self.window is None:
+            self._add_sums (C, Z, sx, sy, syy, nT)
+        else:
+            self.push (self._trial()._add_sums(C, Z, sx, sy, syy, nT))
+
+    def _trial(self):
+        return CovAccumulator (self.n_features, self.dtype, self.packed, self.block)
+
+    def push(self, trial):
+        '''
+        Adds the sums of another accumulator as one trial: the old trials
+        are forgotten and the one leaving the window is downdated.
+        '''
+        if self.forget == 1 and self.window is None:
+            return self.merge (trial)
+        if self.forget != 1:
+            self.scale (self.forget)
+        self.merge (trial)
+        if self.window is not None:
+            self._trials.append (trial)
+            if len(self._trials) > self.window:
+                self.merge (self._trials.popleft(), -self.forget**self.window)
+
+    def scale(self, f):
+        '''
+        Multiplies all the sums (and the sample count) by f.
+        '''
+        self.sxx *= f
+        if self.sxy is not None:
+            self.sxy *= f
+        self.sx  *= f
+        self.sy   = self.sy * f
+        self.syy  = self.syy * f
+        self.n    = self.n * f
+
+    def _update(self, x, teach_sig):
+        nT = x.shape[0]
+        sy, syy = target_sums (teach_sig)
+        teach_sig = np.asarray(teach_sig, dtype=float).reshape([nT,-1])
+        if sparse.issparse(x):
+            G = sparse.triu (x.T.dot(x)).tocoo()
+            if self.packed:
+                self.sxx[G.col*(G.col+1)//2 + G.row] += G.data
+            else:
+                self.sxx[G.row, G.col] += G.data
+        else:
+            x = np.asarray(x, dtype=self.dtype)
+            if self.packed:
+                self._packed_update (x)
+            else:
+                self.sxx = self._syrk (1.0, x.T, beta=1.0, c=self.sxx, \
+                                       trans=0, lower=0, overwrite_c=1)
+        self._add (project(x, teach_sig), np.asarray(x.sum(axis=0)).ravel(), \
+                   sy, syy, nT)
+        return self
+
+    def _add_sums(self, C, Z, sx, sy, syy, nT):
+        C = np.asarray(C)
+        if self.packed:
+            r, c = self._packed_index ()
+            self.sxx += C[r,c]
+        else:
+            self.sxx += np.triu (C)
+        self._add (Z, sx, sy, syy, nT)
+        return self
+
+    def merge(self, other, w = 1):
+        '''
+        Adds w times the sums of another accumulator (any dtype or storage),
+        w = -1 subtracts them. Not a trial: forget and window do not apply.
+        '''
+        if other.n == 0:
+            return self
+        u = w * other.upper()
+        if self.packed:
+            self.sxx += u.astype(self.dtype)
+        else:
+            r, c = self._packed_index ()
+            self.sxx[r,c] += u.astype(self.dtype)
+        self._add (w*other.sxy, w*other.sx, w*np.asarray(other.sy), \
+                   w*np.asarray(other.syy), w*other.n)
+        return self
+
+    def targets(self, cols):
+        '''
+        Keeps the target sums of the columns cols (in that order, repeats
+        copy a column), also those of the trials in the window.
+        '''
+        if self.sxy is not None:
+            self.sxy = self.sxy[:,cols]
+        if np.ndim(self.sy):
+            self.sy  = self.sy[cols]
+            self.syy = self.syy[cols]
+        for trial in self._trials:
+            trial.targets (cols)
+        return self
+
+    def upper(self):
+        '''
+        Upper triangle of the sums x.T x in packed order (float64).
+        '''
+        if self.packed:
+            return self.sxx.astype(np.float64)
+        r, c = self._packed_index ()
+        return self.sxx[r,c].astype(np.float64)
+
+    def _packed_index(self):
+        # (row, col) of the packed entries: column by column, rows 0..col
+        c, r = np.tril_indices (self.n_features)
+        return r, c
+
+    def _add(self, Z, sx, sy, syy, nT):
+        Z = np.asarray(Z, dtype=float).reshape([self.n_features,-1])
+        if self.sxy is None:
+            self.sxy = np.zeros (Z.shape)
+        self.sxy += Z
+        self.sx  += np.ravel(sx)
+        self.sy   = self.sy + np.ravel(sy)
+        self.syy  = self.syy + np.ravel(syy)
+        self.n   += nT
+
+    def _packed_update(self, x):
+        # blocks of columns of the upper triangle, one GEMM each
+        p = self.n_features
+        for j0 in xrange(0, p, self.block):
+            j1 = min(j0 + self.block, p)
+            G  = np.dot (x[:,:j1].T, x[:,j0:j1])
+            for c in xrange(j0, j1):
+                o = c*(c+1)//2
+                self.sxx[o:o+c+1] += G[:c+1,c-j0]
+
+    def cov(self, out = None):
+        '''
+        x.T x / n as a full symmetric float64 array, written into out
+        ([p, p]) when given.
+        '''
+        p = self.n_features
+        if out is None or out.shape != (p,p) or out.dtype != np.float64:
+            out = np.empty ([p,p])
+        if self.packed:
+            for c in xrange(p):
+                o = c*(c+1)//2
+                out[:c+1,c] = self.sxx[o:o+c+1]
+                out[c,:c+1] = self.sxx[o:o+c+1]
+        else:
+            np.add (self.sxx, self.sxx.T, out=out)
+            out.flat[::p+1] /= 2
+        out *= 1.0 / max(self.n, 1)
+        return out
+
+    def stats(self, out = None):
+        '''
+        Averages over the samples: x.T x, x.T teach_sig, x, teach_sig and
+        teach_sig**2 (out as in cov).
+        '''
+        n = max(self.n, 1)
+        if self.sxy is None:
+            return self.cov(out), np.zeros([self.n_features,1]), self.sx / n, \
+                   self.sy / n, self.syy / n
+        return self.cov(out), self.sxy / n, self.sx / n, self.sy / n, \
+               self.syy / n
+
+def active_rows (C, tol = 1e-6):
+    '''
+    Mask of the regressors (neurons) with activity: rows of the covariance
+    C whose absolute sum is above tol times the largest one. Silent neurons
+    have zero rows. (s_track.m: find(sum(abs(C),2)>1e-4))
+    '''
+    r = np.sum (np.abs(C), axis=1)
+    return r > tol * np.max(r) if len(r) and np.max(r) > 0 else r > 0
+
+STATS_VERSION = 1
+
+def save_stats (filename, accums, cols = None, mix = None):
+    '''
+    Saves the sums of the readout accumulators {key: CovAccumulator} to a
+    compressed .npz file (versioned, x.T x as packed upper triangle).
+    cols, mix -> unique targets the sums were taken on (unique_targets)
+    '''
+    out = {"version": STATS_VERSION, "keys": np.array(sorted(accums))}
+    if cols is not None:
+        out["teach_cols"] = cols
+    if mix is not None:
+        out["teach_mix"] = mix
+    for key, acc in accums.items():
+        out[key+"_n_features"] = acc.n_features
+        out[key+"_n"]   = acc.n
+        out[key+"_sxx"] = acc.upper()
+        out[key+"_sx"]  = acc.sx
+        out[key+"_sy"]  = np.atleast_1d(acc.sy)
+        out[key+"_syy"] = np.atleast_1d(acc.syy)
+        if acc.sxy is not None:
+            out[key+"_sxy"] = acc.sxy
+    np.savez_compressed (filename, **out)
+
+def load_stats (filename, dtype = np.float64, packed = False, with_mix = False):
+    '''
+    Accumulators {key: CovAccumulator} saved by save_stats.
+    with_mix -> also return the unique targets cols, mix (None if absent)
+    '''
+    f = np.load (filename)
+    if int(f["version"]) != STATS_VERSION:
+        raise ValueError ("unknown readout statistics version %d in %s" \
+                          % (int(f["version"]), filename))
+    accums = {}
+    for key in f["keys"]:
+        key = str(key)
+        acc = CovAccumulator (int(f[key+"_n_features"]), dtype, packed)
+        n   = float(f[key+"_n"]) # fractional with forget
+        if n != 0:
+            u = f[key+"_sxx"]
+            if packed:
+                acc.sxx += u
+            else:
+                r, c = acc._packed_index ()
+                acc.sxx[r,c] = u
+            acc._add (f[key+"_sxy"], f[key+"_sx"], f[key+"_sy"], f[key+"_syy"], n)
+        accums[key] = acc
+    cols = f["teach_cols"] if "teach_cols" in f.files else None
+    mix  = f["teach_mix"] if "teach_mix" in f.files else None
+    f.close()
+    if with_mix:
+        return accums, cols, mix
+    return accums
+
+def same_mix (a, b):
+    '''
+    True if the unique targets (cols, mix) a and b are the same.
+    '''
+    for u, v in zip(a, b):
+        if (u is None) != (v is None):
+            return False
+        if u is not None and (np.shape(u) != np.shape(v) or not np.allclose(u, v)):
+            return False
+    return True
+
+def merge_stats (stats, with_mix = False):
+    '''
+    Merges any number of {key: CovAccumulator} (or files saved by
+    save_stats): the sums add up, so every sample keeps its weight. Files
+    whose sums were taken on different unique targets are refused.
+    with_mix -> also return their unique targets cols, mix
+    '''
+    merged = {}
+    teach  = None
+    for s in stats:
+        if isinstance(s, dict):
+            cur = (None, None)
+        else:
+            s, cols, mix = load_stats (s, with_mix=True)
+            cur = (cols, mix)
+        if teach is None:
+            teach = cur
+        elif not same_mix (teach, cur):
+            raise ValueError ("the statistics were taken on different "+\
+                              "teaching signal columns (unique targets)")
+        for key, acc in s.items():
+            if key not in merged:
+                merged[key] = CovAccumulator (acc.n_features, acc.dtype, acc.packed)
+            merged[key].merge (acc)
+    if with_mix:
+        return (merged,) + (teach if teach is not None else (None, None))
+    return merged
+
+def loto (trials, alpha = None, alphas = np.logspace(-6,3,50), \
+          fit_intercept = False, score = None, per_target = False, \
+          prune_tol = 1e-6):
+    '''
+    Leave-one-trial-out evaluation of the ridge readout. The sums of every
+    trial are kept, the readout without trial i is solved from the totals
+    minus those of trial i (downdating) and scored on trial i. Unless given,
+    alpha is chosen by GCV for every fold from its downdated statistics
+    (RidgePath.fit_stats), so the held-out trial plays no part in it. That
+    costs one eigendecomposition per trial, a given alpha one p x p
+    Cholesky solve per trial.
+    trials -> list of (x, teach_sig), x dense or scipy.sparse [nT_i, p]
+    alpha -> scalar or [k] (one for every target column)
+    score -> score(teach_sig, prediction) of a held-out trial, default the
+             normalized RMSE sqrt(mean((y-yh)**2)/mean(y**2))
+    alphas, fit_intercept, per_target, prune_tol -> as in RidgePath
+    Returns the scores, the held-out predictions and alpha (that of every
+    fold when chosen).
+    '''
+    p   = trials[0][0].shape[1]
+    acc = [CovAccumulator(p)._update(x, y) for x, y in trials]
+    tot = CovAccumulator(p)
+    for a in acc:
+        tot.merge (a)
+    S = tot.cov() * tot.n
+    scores, preds, chosen = [], [], []
+    for (x, y), a in zip(trials, acc):
+        n  = tot.n - a.n
+        C  = (S - a.cov()*a.n) / n
+        Z  = (tot.sxy - a.sxy) / n
+        xm = (tot.sx - a.sx) / n
+        ym = (tot.sy - a.sy) / n
+        if alpha is None:
+            reg = RidgePath(alphas, fit_intercept, prune_tol=prune_tol, \
+                            per_target=per_target)
+            reg.fit_stats(C, Z, n, (tot.syy - a.syy) / n, xm, ym)
+            chosen.append (reg.alpha_)
+            yh = np.asarray(reg.predict(x)).reshape([x.shape[0],-1])
+        else:
+            w, b = _ridge_solve (C, Z, xm, ym, alpha, fit_intercept, prune_tol)
+            yh = np.asarray(x.dot(w)) + b
+        y  = np.asarray(y, dtype=float).reshape(yh.shape)
+        if score is None:
+            scores.append (np.sqrt(np.mean((y - yh)**2) / np.mean(y**2)))
+        else:
+            scores.append (score(y, yh))
+        preds.append (yh)
+    if alpha is None:
+        alpha = np.array(chosen)
+    return np.array(scores), preds, alpha
+
+def _ridge_solve (C, Z, xm, ym, alpha, fit_intercept, prune_tol):
+    # ridge weights and intercept from the moments for a given alpha (scalar
+    # or one for every column), a Cholesky solve of the active regressors
+    p   = C.shape[0]
+    Z   = Z.reshape([p,-1])
+    act = np.ones (p, dtype=bool) if prune_tol is None else active_rows (C, prune_tol)
+    C, Z, xm = C[np.ix_(act,act)], Z[act], (xm * np.ones(p))[act]
+    if fit_intercept:
+        C = C - np.outer(xm, xm)
+        Z = Z - np.outer(xm, ym)
+    alpha = np.atleast_1d(alpha).astype(float)
+    cols  = [slice(None)] if len(alpha) == 1 else [[j] for j in xrange(len(alpha))]
+    wa    = np.zeros (Z.shape)
+    for j, a in zip(cols, alpha):
+        Ca = C.copy()
+        Ca.flat[::Ca.shape[0]+1] += a
+        wa[:,j] = cho_solve (cho_factor(Ca, overwrite_a=True), Z[:,j])
+    w = np.zeros ([p, Z.shape[1]])
+    w[act] = wa
+    b = ym - np.dot(xm, wa) if fit_intercept else 0
+    return w, b
+
+class RidgePath:
+    '''
+    Ridge regression for a whole grid of regularization parameters from a
+    single eigendecomposition of X.T X. It replaces RidgeCV(alphas).fit(X,y)
+    in the readouts: the weights of every alpha are a diagonal rescaling in
+    the eigenbasis, w(alpha) = V diag(1/(lam+alpha)) V.T X.T y, and alpha is
+    chosen by the same efficient leave-one-out error over the rows of X.
+    fit_stats solves the regression on the time samples from their moments
+    instead, choosing alpha by generalized cross-validation.
+    Exposes coef_, intercept_, alpha_ and predict like RidgeCV.
+    select -> 'gcv' (fit_stats) or 'loo' (fit on the covariance rows), the
+              readouts use it to pick the fit
+    prune_tol -> fit_stats solves only the active regressors (active_rows)
+                 and gives zero weight to the others, None solves them all
+    per_target -> choose alpha for every target column (e.g. the time scales
+                  of a multi-scale teacher) from the same factorization,
+                  alpha_ is then [k] and cv_errors_ [n_alphas, k]
+    '''
+    def __init__(self, alphas = np.logspace(-6,3,50), fit_intercept = False, \
+                 select = 'gcv', prune_tol = 1e-6, per_target = False):
+        self.alphas = np.atleast_1d(alphas).astype(float)
+        self.fit_intercept = fit_intercept
+        self.select = select
+        self.prune_tol = prune_tol
+        self.per_target = per_target
+        self.active_   = None
+        self.coef_      = None
+        self.intercept_ = 0.0
+        self.alpha_     = None
+        self.cv_errors_ = None
+
+    def fit(self, X, y, weights = None):
+        '''
+        X -> [n, p] regressors (the readouts pass the covariance matrix)
+        y -> [n] or [n, k] targets
+        weights -> of the target columns in the shared choice of alpha, e.g.
+                   their number of copies (unique_targets), default equal
+        '''
+        X  = np.asarray(X, dtype=float)
+        y  = np.asarray(y, dtype=float)
+        y1 = y.ndim == 1
+        y  = y.reshape([X.shape[0],-1])
+        if self.fit_intercept:
+            xm = np.mean(X, axis=0)
+            ym = np.mean(y, axis=0)
+            X  = X - xm
+            y  = y - ym
+        # the only factorization
+        lam, V = np.linalg.eigh (np.dot(X.T, X))
+        lam = np.maximum (lam, 0)
+        U   = np.dot (X, V)                          # X V
+        Uy  = np.dot (U.T, y)                        # V.T X.T y
+        F   = 1.0 / (lam[None,:] + self.alphas[:,None])  # [n_alphas, p]
+        # leave-one-out residuals (y - X w)/(1 - h) for every alpha, the
+        # unpenalized intercept adds 1/n to the leverages
+        H   = np.dot (U**2, F.T)                     # leverages [n, n_alphas]
+        if self.fit_intercept:
+            H += 1.0 / X.shape[0]
+        err = np.zeros ([len(self.alphas), y.shape[1]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in xrange(len(self.alphas)):
+                r      = (y - np.dot(U, F[i][:,None]*Uy)) / (1 - H[:,i])[:,None]
+                err[i] = np.mean (r**2, axis=0)
+        err[np.isnan(err)] = np.inf
+        best, err = self._select (err, weights)
+
+        coef = np.dot (V, F[best].T*Uy)              # [p, k]
+        self.alpha_     = self._alpha (best, y1)
+        self.cv_errors_ = err
+        self.coef_      = coef.T
+        if self.fit_intercept:
+            self.intercept_ = ym - np.dot(xm, coef)
+        else:
+            self.intercept_ = np.zeros (coef.shape[1])
+        if y1:
+            self.coef_      = self.coef_.ravel()
+            self.intercept_ = self.intercept_[0]
+        return self
+
+    def fit_stats(self, C, Z, n, ysq, xm = None, ym = None, weights = None):
+        '''
+        Ridge regression on n time samples given their moments (averages
+        over the samples), W = (C + alpha I)^-1 Z, with alpha chosen by
+        generalized cross-validation, never visiting the samples:
+            RSS/n = ysq - sum_k z_k**2 (l_k+2 alpha)/(l_k+alpha)**2
+            df    = sum_k l_k/(l_k+alpha)
+            GCV   = RSS/n / (1 - df/n)**2
+        with l_k, z_k the eigenvalues of C and Z in its eigenbasis.
+        C -> x.T x / n [p, p]
+        Z -> x.T y / n [p] or [p, k]
+        n -> number of samples
+        ysq -> mean of y**2 [k]
+        xm, ym -> means of x and y, needed with fit_intercept
+        weights -> see fit
+        Inactive regressors are left out of the solve (see prune_tol), the
+        weights are returned full size.
+        '''
+        C   = np.asarray(C, dtype=float)
+        Z   = np.asarray(Z, dtype=float)
+        z1  = Z.ndim == 1
+        p   = C.shape[0]
+        Z   = Z.reshape([p,-1])
+        ysq = np.asarray(ysq, dtype=float).ravel()
+        if self.prune_tol is None:
+            act = np.ones (p, dtype=bool)
+        else:
+            act = active_rows (C, self.prune_tol)
+        self.active_ = act
+        if not np.all(act):
+            C = C[np.ix_(act,act)]
+            Z = Z[act]
+            if xm is not None:
+                xm = (np.asarray(xm, dtype=float).ravel() * np.ones(p))[act]
+        df0 = 0
+        if self.fit_intercept:
+            xm  = np.asarray(xm, dtype=float).ravel()
+            ym  = np.asarray(ym, dtype=float).ravel()
+            C   = C - np.outer(xm, xm)
+            Z   = Z - np.outer(xm, ym)
+            ysq = ysq - ym**2
+            df0 = 1
+        lam, V = np.linalg.eigh (C)
+        lam = np.maximum (lam, 0)
+        Zt  = np.dot (V.T, Z)
+        L   = lam[None,:] + self.alphas[:,None]      # [n_alphas, p]
+        rss = ysq - np.dot ((L + self.alphas[:,None])/L**2, Zt**2) # [n_alphas, k]
+        df  = df0 + np.sum (lam[None,:]/L, axis=1)
+        err = np.where ((df < n)[:,None], np.maximum(rss, 0) / (1 - df/n)[:,None]**2, np.inf)
+        best, err = self._select (err, weights)
+
+        coef = np.zeros ([p, Z.shape[1]])
+        coef[act] = np.dot (V, Zt / L[best].T)
+        self.alpha_     = self._alpha (best, z1)
+        self.cv_errors_ = err
+        self.coef_      = coef.T
+        if self.fit_intercept:
+            self.intercept_ = ym - np.dot(xm, coef[act])
+        else:
+            self.intercept_ = np.zeros (coef.shape[1])
+        if z1:
+            self.coef_      = self.coef_.ravel()
+            self.intercept_ = self.intercept_[0]
+        return self
+
+    def _select(self, err, weights = None):
+        '''
+        Index of the best alpha of every target column given the errors
+        [n_alphas, k]. Without per_target the columns share the alpha of the
+        (weighted) mean error, the errors are returned averaged.
+        '''
+        if not self.per_target:
+            if weights is None:
+                err = np.mean (err, axis=1)
+            else:
+                err = np.dot (err, weights) / np.sum(weights)
+            return np.repeat (np.argmin(err), 1), err
+        return np.argmin (err, axis=0), err
+
+    def _alpha(self, best, y1):
+        if self.per_target and not y1:
+            return self.alphas[best]
+        return self.alphas[best[0]]
+
+    def predict(self, X):
+        '''
+        X -> [nT, p] dense or scipy.sparse
+        '''
+        return X.dot(self.coef_.T) + self.intercept_
+
+    def score(self, X, y):
+        '''
+        Coefficient of determination R^2 of the prediction.
+        '''
+        y  = np.asarray(y, dtype=float)
+        yh = np.asarray(self.predict(X)).reshape(y.shape)
+        return 1 - np.sum((y - yh)**2) / np.sum((y - np.mean(y, axis=0))**2)
+
+class RLS:
+    '''
+    Recursive least squares readout. Keeps the inverse correlation matrix P
+    of the regressors and updates the weights sample by sample in O(p^2):
+        g = P x / (forget + x.T P x)
+        W = W + g (y - W.T x).T
+        P = (P - g x.T P) / forget
+    forget -> forgetting factor in (0, 1], 1 means no forgetting
+    alpha -> ridge regularization, on the scale of RidgePath.fit_stats
+    With fit_intercept the regressors get an unpenalized constant entry.
+    fit_stats starts it from the moments of the samples seen so far, giving
+    the ridge solution. The penalty stays that of the starting state (n*alpha
+    on the sums), it does not grow with the new samples.
+    Exposes coef_, intercept_ and predict like RidgePath.
+    '''
+    select = 'rls'
+
+    def __init__(self, n_features, forget = 1.0, alpha = 1.0, \
+                 fit_intercept = False):
+        self.n_features    = n_features
+        self.forget        = forget
+        self.alpha_        = alpha
+        self.fit_intercept = fit_intercept
+        p = n_features + (1 if fit_intercept else 0)
+        self.P = np.eye (p) / alpha
+        self.W = None # [p, n_targets], sized by the first targets seen
+
+    def fit_stats(self, C, Z, n, ysq = None, xm = None, ym = None, weights = None):
+        '''
+        Restarts from the moments (averages over n samples) of the data seen
+        so far, see RidgePath.fit_stats. ysq and weights are not needed.
+        '''
+        C = np.asarray(C, dtype=float)
+        Z = np.asarray(Z, dtype=float).reshape([C.shape[0],-1])
+        p = C.shape[0]
+        reg = self.alpha_ * np.ones(p)
+        if self.fit_intercept:
+            xm  = np.asarray(xm, dtype=float).ravel() * np.ones(p)
+            ym  = np.asarray(ym, dtype=float).ravel() * np.ones(Z.shape[1])
+            C   = np.vstack ((np.column_stack((C, xm)), np.append(xm, 1)))
+            Z   = np.vstack ((Z, ym))
+            reg = np.append (reg, 0)
+        if n == 0:
+            self.P = np.eye (len(reg)) / self.alpha_
+            self.W = np.zeros ([len(reg), Z.shape[1]])
+            return self
+        self.P = np.linalg.inv (n*(C + np.diag(reg)))
+        self.W = np.dot (self.P, n*Z)
+        return self
+
+    def partial_fit(self, X, y):
+        '''
+        Updates the weights with every sample (row) of X, in order.
+        X -> [nT, p] dense or scipy.sparse
+        y -> [nT] or [nT, k] targets
+        '''
+        if sparse.issparse(X):
+            X = X.toarray()
+        X = np.atleast_2d (np.asarray(X, dtype=float))
+        y = np.asarray(y, dtype=float).reshape([X.shape[0],-1])
+        if self.fit_intercept:
+            X = np.column_stack ((X, np.ones(X.shape[0])))
+        if self.W is None:
+            self.W = np.zeros ([X.shape[1], y.shape[1]])
+        P, W, lam = self.P, self.W, self.forget
+        for x, t in zip(X, y):
+            Px = np.dot (P, x)
+            g  = Px / (lam + np.dot(x, Px))
+            W += np.outer (g, t - np.dot(x, W))
+            P -= np.outer (g, Px)
+            if lam != 1:
+                P /= lam
+        self.P = (P + P.T) / 2
+        return self
+
+    @property
+    def coef_(self):
+        return self.W[:self.n_features].T
+
+    @property
+    def intercept_(self):
+        if self.fit_intercept:
+            return self.W[self.n_features]
+        return np.zeros (self.W.shape[1])
+
+    def predict(self, X):
+        '''
+        X -> [nT, p] dense or scipy.sparse
+        '''
+        return X.dot(self.coef_.T) + self.intercept_
+
+def _xridge_fold (job):
+    '''
+    Validation error of every lambda for one fold, from one SVD of its
+    training samples (pool worker of xridgereg).
+    '''
+    data, x, train, l, efunc = job
+    valid = np.logical_not (train)
+    u, s, wt = np.linalg.svd (data[train], full_matrices=False)
+    Utx = np.dot (u.T, x[train])
+    P   = np.dot (data[valid], wt.T)
+    err = np.zeros (len(l))
+    for i in xrange(len(l)):
+        xh = np.dot (P, (s/(s**2 + l[i]**2))[:,None] * Utx)
+        if efunc is None:
+            err[i] = np.sum ((x[valid] - xh)**2)
+        else:
+            err[i] = efunc (x[valid], xh)
+    return err
+
+def xridgereg (data, x, l = None, k = 10, trials = None, efunc = None, \
+               pool = None, seed = None):
+    '''
+    Ridge regression data*b = x with k-fold cross-validation over the time
+    samples (port of mFiles/xridgereg.m). Each fold is factorized once
+    (SVD of its training samples) and the whole lambda grid is evaluated
+    from the cached factors. The penalty is l**2, as in the Octave version.
+    data -> [nT, p] time samples (e.g. ts2sig output, trials stacked)
+    x -> [nT] or [nT, n_teach] targets
+    l -> lambdas, default logspace(-6,2,50) (the Octave version refines
+         the best of a coarse grid with sqp instead)
+    k -> number of folds
+    trials -> trial of every sample, folds are then made of whole trials
+    efunc -> error function efunc(x, xh) of a fold, default sum of squares
+    pool -> multiprocessing pool, the folds are run in parallel
+    seed -> seed of the random assignment to folds
+    Returns b [p] or [p, n_teach], the chosen lambda and the mean
+    validation error of every lambda.
+    '''
+    data = np.asarray(data, dtype=float)
+    x    = np.asarray(x, dtype=float)
+    x1   = x.ndim == 1
+    x    = x.reshape([data.shape[0],-1])
+    l    = np.logspace(-6,2,50) if l is None else np.atleast_1d(l).astype(float)
+
+    if trials is None:
+        label = np.arange(data.shape[0])
+    else:
+        label = np.unique(trials, return_inverse=True)[1]
+    nU = np.max(label) + 1
+    if nU < 2:
+        raise ValueError ("cross-validation needs at least 2 %s, got %d" \
+                          % ("samples" if trials is None else "trials", nU))
+    if nU <= k:
+        warnings.warn ("subset bigger (k=%d) than whole data set (n=%d)! Taking k=n-1" \
+                       % (k, nU))
+        k = nU - 1
+    fold  = np.zeros (nU, dtype=int)
+    for i, f in enumerate(np.array_split(np.random.RandomState(seed).permutation(nU), k)):
+        fold[f] = i
+    fold  = fold[label]
+    jobs  = [(data, x, fold != i, l, efunc) for i in xrange(k)]
+    if pool is None:
+        err = [_xridge_fold(job) for job in jobs]
+    else:
+        err = pool.map (_xridge_fold, jobs)
+    err  = np.sum (err, axis=0) / k
+    best = np.argmin (err)
+
+    u, s, wt = np.linalg.svd (data, full_matrices=False)
+    b = np.dot (wt.T, (s/(s**2 + l[best]**2))[:,None] * np.dot(u.T, x))
+    if x1:
+        b = b.ravel()
+    return b, l[best], err
+
+class ReadoutState:
+    '''
+    State and orchestration of the "input" and "output" readouts shared by
+    Lsm and Reservoir: the accumulators of the statistics, their averages
+    (CovMatrix, ProjTeach, means), the regressors and weights, the refit
+    policy and the unique-target mix. The classes only delegate to it.
+    alphas, fit_intercept, per_target, prune_tol -> of the RidgePath
+                                                   regressors
+    dtype, packed, forget, window -> of the accumulators (CovAccumulator)
+    refit_policy, refit_every, refit_tol -> when the readouts are solved
+                                            (see _refit)
+    '''
+    keys = ("input", "output")
+
+    def __init__(self, n_features, alphas = np.logspace(-6,3,50), \
+                 fit_intercept = False, dtype = np.float64, packed = False, \
+                 refit_policy = 'trial', refit_every = 10, refit_tol = 1e-2, \
+                 forget = 1.0, window = None, per_target = False, \
+                 prune_tol = 1e-6):
+        p = n_features
+        self.n_features  = p
+        self.alphas        = alphas
+        self.fit_intercept = fit_intercept
+        self.per_target    = per_target
+        self.prune_tol     = prune_tol
+        self.CovMatrix   = dict((key, np.zeros([p,p])) for key in self.keys) # Covariance matrix of inputs and outputs
+        self.ReadoutW    = dict((key, np.zeros([p,1])) for key in self.keys) # Readout weights
+        self.ProjTeach   = dict((key, np.zeros([p,1])) for key in self.keys) # Teaching signal projected on inputs and outputs
+        self.regressor   = dict((key, RidgePath(alphas=alphas, fit_intercept=fit_intercept, \
+                                                prune_tol=prune_tol, per_target=per_target)) \
+                                for key in self.keys) # Ridge path, one factorization for all alphas
+        self.runningMean = dict((key, 0) for key in self.keys)
+        self.TeachMean   = dict((key, 0) for key in self.keys)
+        self.TeachSq     = dict((key, 0) for key in self.keys)
+        self.TeachMix    = None # Unique targets, see unique_targets
+        self.TeachCols   = None
+        self.Accum       = dict((key, CovAccumulator(p, dtype, packed, forget=forget, \
+                                                     window=window)) \
+                                for key in self.keys) # Running sums of the statistics
+        self.refit_policy = refit_policy
+        self.refit_every  = refit_every
+        self.refit_tol    = refit_tol
+        self.trials       = 0
+        self.samples      = 0
+        self._stale       = set()
+        self._solved      = {}
+
+    def learn(self, data, teach_sig, mix = None):
+        '''
+        Regression of teach_sig on the states of every readout,
+        data = {key: x} with x dense or scipy.sparse [nT, n_features].
+        mix -> unique targets, see unique_targets
+        '''
+        teach_sig = self.unique_targets (teach_sig, mix)
+        # Covariance matrix and projection of data, in place
+        for key, x in data.items():
+            self.Accum[key].update (x, teach_sig)
+            nT = x.shape[0]
+        self._refit (data.keys(), nT)
+
+    def learn_stats(self, stats, nT):
+        '''
+        Updates the readouts with the statistics of nT new samples,
+        stats[key] = moments(x, teach_sig) for key "input" and/or "output":
+        sums over the samples of x.T x, x.T teach_sig, x, teach_sig and
+        teach_sig**2 (teach_sig already reduced by unique_targets).
+        '''
+        for key, s in stats.items():
+            self.Accum[key].add (*(tuple(s) + (nT,)))
+        self._refit (stats.keys(), nT)
+
+    def rls(self, forget = 1.0, alpha = None):
+        '''
+        Switches the readouts to recursive least squares (RLS), updated with
+        every sample by rls_learn. They start from the current statistics and
+        predict like the ridge readouts.
+        forget -> forgetting factor in (0, 1], 1 means no forgetting
+        alpha -> regularization, default the one of the last ridge fit
+        '''
+        self.solve ()
+        for key in self.keys:
+            reg = self.regressor[key]
+            a   = alpha if alpha is not None else reg.alpha_
+            if a is None:
+                a = 1.0
+            a   = np.exp (np.mean (np.log (a))) # one P for all the targets
+            rls = RLS(self.n_features, forget=forget, alpha=a, \
+                      fit_intercept=reg.fit_intercept)
+            rls.fit_stats(self.CovMatrix[key], self.ProjTeach[key], self.Accum[key].n, \
+                          None, self.runningMean[key], self.TeachMean[key])
+            self.regressor[key] = rls
+
+    def rls_learn(self, data, teach_sig, mix = None):
+        '''
+        Per sample update of the RLS readouts (see rls), data = {key: x}.
+        mix -> unique targets, see unique_targets
+        '''
+        teach_sig = self.unique_targets (teach_sig, mix)
+        for key, x in data.items():
+            self.regressor[key].partial_fit(x, teach_sig)
+            self.ReadoutW[key] = self.expand (self.regressor[key].coef_.T)
+
+    def predict(self, data):
+        '''
+        Predictions {key: [nT, n_teach]} of the readouts, data = {key: x}.
+        '''
+        self.solve ([key for key in self._stale if self.refit_policy == 'predict' \
+                     or self.regressor[key].coef_ is None])
+        return dict((key, self.expand (self.regressor[key].predict(x))) \
+                    for key, x in data.items())
+
+    def save_stats(self, filename):
+        '''
+        Saves the statistics (save_stats) to resume the training later or to
+        merge them with those of other runs.
+        '''
+        save_stats (filename, self.Accum, self.TeachCols, self.TeachMix)
+
+    def load_stats(self, filenames, merge = False):
+        '''
+        Loads statistics saved by save_stats. Several files (e.g. slices of
+        the trials processed on different machines) are merged with the
+        right sample weighting, and the readouts are refitted. With forget
+        or window they count as one trial, forgotten like the others.
+        merge -> add them to the current statistics instead of replacing them
+        '''
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        loaded, cols, mix = merge_stats (filenames, with_mix=True)
+        if merge and self.samples > 0:
+            if not same_mix ((self.TeachCols, self.TeachMix), (cols, mix)):
+                raise ValueError ("the statistics were taken on different "+\
+                                  "teaching signal columns (unique targets)")
+        else:
+            self.TeachCols, self.TeachMix = cols, mix
+            self._solved = {}
+        if not merge:
+            self.samples = 0
+            self.trials  = 0
+        for key, acc in loaded.items():
+            cur = self.Accum[key]
+            if not merge:
+                self.Accum[key] = CovAccumulator (cur.n_features, cur.dtype, cur.packed, \
+                                                  forget=cur.forget, window=cur.window)
+            self.Accum[key].push (acc) # one trial, it also leaves the window
+        self._refit (loaded.keys(), max([acc.n for acc in loaded.values()]))
+
+    def loto(self, trials, alpha = None):
+        '''
+        Leave-one-trial-out evaluation of the output readout (see loto) with
+        its settings. An RLS readout is scored at its own alpha, as the ridge
+        solution it starts from (no pruning).
+        '''
+        reg = self.regressor["output"]
+        prune_tol = self.prune_tol
+        if isinstance(reg, RLS):
+            if alpha is None:
+                alpha = reg.alpha_
+            prune_tol = None
+        return loto (trials, alpha, self.alphas, self.fit_intercept, None, \
+                     self.per_target, prune_tol)
+
+    def export(self, filename, key = "output", kernel = None):
+        '''
+        Exports the trained readout of key for deployment, see
+        inference.save_readout. The readouts are left as they are: a ridge
+        readout with new statistics is solved on a copy, an RLS readout is
+        exported with its current weights.
+        '''
+        reg = self.regressor[key]
+        if key in self._stale and not isinstance(reg, RLS):
+            reg = self._fit (copy.copy(reg), key)
+        inference.save_readout (filename, self.expand (reg.coef_.T), \
+                                self.expand (np.atleast_1d(reg.intercept_)), \
+                                getattr(reg, "active_", None), kernel)
+
+    def unique_targets(self, teach_sig, mix = None):
+        '''
+        Reduces teach_sig to its unique columns (unique_targets), e.g. one
+        column for a target copied into all of them or given as a
+        np.broadcast_to view. Only those are accumulated and solved, the
+        weights and predictions are copied back into all the columns. The
+        copies are found on the first trial. When a later trial breaks them
+        (e.g. a column that was zero), the readouts go back to solving all
+        the columns (see _unfold).
+        mix -> teach_sig holds only the unique targets, mix [n_unique, n_teach]
+               gives every column (pass it on every trial), e.g. for linearly
+               dependent targets, which are not detected
+        '''
+        if mix is not None:
+            self.TeachMix = np.asarray(mix, dtype=float)
+            return teach_sig
+        if np.ndim(teach_sig) == 1 or (self.TeachCols is None and self.samples > 0):
+            return teach_sig
+        if self.TeachCols is None:
+            cols, mix = unique_targets (teach_sig, dependent=False)
+            if len(cols) == np.shape(teach_sig)[1]:
+                return teach_sig
+            self.TeachCols, self.TeachMix = cols, mix
+        teach_u = np.asarray(teach_sig)[:,self.TeachCols].astype(float)
+        if not np.allclose (np.dot(teach_u, self.TeachMix), teach_sig):
+            self._unfold ()
+            return teach_sig
+        return teach_u
+
+    def _unfold(self):
+        '''
+        Goes back to solving all the target columns: the sums of every unique
+        target are copied into its columns, exactly the sums of all the
+        columns since they were copies, so nothing is lost.
+        '''
+        cols = np.argmax (self.TeachMix, axis=0) # unique target of every column
+        for acc in self.Accum.values():
+            acc.targets (cols)
+        # the weights of the last solve, until the next one
+        for reg in self.regressor.values():
+            if isinstance(reg, RLS):
+                if reg.W is not None:
+                    reg.W = reg.W[:,cols]
+            elif reg.coef_ is not None and np.ndim(reg.coef_) == 2:
+                reg.coef_      = reg.coef_[cols]
+                reg.intercept_ = np.atleast_1d(reg.intercept_)[cols]
+                if np.ndim(reg.alpha_):
+                    reg.alpha_ = reg.alpha_[cols]
+        self.TeachCols, self.TeachMix = None, None
+        self._solved = {}
+        keys = [key for key in self.keys if self.Accum[key].n != 0]
+        self._average (keys)
+        self._stale.update (keys)
+
+    def expand(self, a):
+        '''
+        Weights or predictions of the unique targets for all the columns.
+        '''
+        if self.TeachMix is None:
+            return a
+        return np.dot (a, self.TeachMix)
+
+    def _refit(self, keys, nT):
+        '''
+        Refreshes the averaged statistics of the readouts in keys from their
+        accumulators (in place) after a trial of nT samples, and solves them
+        again according to refit_policy:
+            'trial'   -> after every trial
+            'predict' -> only on demand (predict, solve)
+            'every'   -> every refit_every trials
+            'change'  -> when CovMatrix or ProjTeach moved by more than
+                         refit_tol (relative Frobenius norm) since the last
+                         solve
+        Until then the weights, and predict, stay those of the last solve.
+        '''
+        self._average (keys)
+        self._stale.update (keys)
+
+        # Update samples
+        self.samples += nT
+        self.trials  += 1
+
+        if self.refit_policy == 'trial':
+            self.solve ()
+        elif self.refit_policy == 'every' and self.trials % self.refit_every == 0:
+            self.solve ()
+        elif self.refit_policy == 'change':
+            self.solve ([key for key in self._stale \
+                         if self._change(key) > self.refit_tol])
+
+    def _average(self, keys):
+        for key in keys:
+            # Update cov matrix, projection and means
+            C, Z, xm, ym, ysq    = self.Accum[key].stats (out=self.CovMatrix[key])
+            self.CovMatrix[key]  = C
+            self.ProjTeach[key]  = Z
+            self.runningMean[key] = xm
+            self.TeachMean[key]   = ym
+            self.TeachSq[key]     = ysq
+
+    def _fit(self, reg, key):
+        # regressor reg fitted to the statistics of readout key
+        C, Z = self.CovMatrix[key], self.ProjTeach[key]
+        # columns of every unique target, they weigh in the choice of alpha
+        w = None if self.TeachMix is None else np.sum (self.TeachMix**2, axis=1)
+        if reg.select == 'loo':
+            return reg.fit(C, Z, w)
+        return reg.fit_stats(C, Z, self.Accum[key].n, self.TeachSq[key], \
+                             self.runningMean[key], self.TeachMean[key], w)
+
+    def _change(self, key):
+        '''
+        Relative change of the statistics of a readout since its last solve.
+        '''
+        if key not in self._solved:
+            return np.inf
+        C0, Z0 = self._solved[key]
+        dC = np.linalg.norm (self.CovMatrix[key] - C0) / max(np.linalg.norm(C0), 1e-300)
+        dZ = np.linalg.norm (self.ProjTeach[key] - Z0) / max(np.linalg.norm(Z0), 1e-300)
+        return max(dC, dZ)
+
+    def solve(self, keys = None):
+        '''
+        Solves the readouts in keys (default all with new statistics).
+        '''
+        if keys is None:
+            keys = list(self._stale)
+        for key in keys:
+            C, Z = self.CovMatrix[key], self.ProjTeach[key]
+            reg  = self._fit (self.regressor[key], key)
+            self.ReadoutW[key]   = self.expand (reg.coef_.T)
+            if self.refit_policy == 'change':
+                self._solved[key] = (C.copy(), np.copy(Z))
+            self._stale.discard (key)
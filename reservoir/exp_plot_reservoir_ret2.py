@@ -31,6 +31,7 @@ from pylab import *
 import sys
 import matplotlib
 import reservoir as L
+import scoring
 import time
 import glob        #command line parser
 from mpl_toolkits.mplot3d import Axes3D
@@ -167,38 +168,29 @@ if flag["reload"]:
 
     t_analog = np.linspace(0,T,nT) # milliseconds
 
+    def _load_trials(index):
+        for i in index:
+            outputs = np.loadtxt(outputs_dat[i])
+            yield outputs[:,0], outputs[:,1]
+
     print "### PRE-LOADING TRAINING DATA"
     # Pre-load training data
-    X_train = []
-    W_train = []
-    for i in xrange(n_teach):
-        outputs = np.loadtxt(outputs_dat[index_teaching[i]])
-        omegas  = np.loadtxt(omegas_dat[index_teaching[i]])
-        X = L.ts2sig(t_analog, membrane, \
-                     outputs[:,0], outputs[:,1], n_neu = 256)
-        X_train.append(X)
-        W_train.append(omegas)
-
-    W_train = np.array (W_train)
+    X_train = L.ts2sig_trials(t_analog, membrane, _load_trials(index_teaching), \
+                              n_neu = 256, n_trials = n_teach, \
+                              method = 'window', radius = 5*dt_spk2sig)
+    W_train = np.array([np.loadtxt(omegas_dat[i]) for i in index_teaching])
 
     print "### PRE-LOADING TEST DATA"
     # Pre-load training data
-    X_test = []
-    W_test = []
-    for i in xrange(n_test):
-        outputs = np.loadtxt(outputs_dat[index_testing[i]])
-        omegas  = np.loadtxt(omegas_dat[index_testing[i]])
-        X = L.ts2sig(t_analog, membrane, \
-                     outputs[:,0], outputs[:,1], n_neu = 256)
-
-        X_test.append(X)
-        W_test.append(omegas)
-
-    W_test = np.array (W_test)
+    X_test = L.ts2sig_trials(t_analog, membrane, _load_trials(index_testing), \
+                             n_neu = 256, n_trials = n_test, \
+                             method = 'window', radius = 5*dt_spk2sig)
+    W_test = np.array([np.loadtxt(omegas_dat[i]) for i in index_testing])
 
 
     print "### CUTING DATA"
-    activation = np.array (map(lambda x: np.mean(x**2,axis=1),X_train)).T
+    activation = np.array([np.mean(X_train[:,:,i]**2,axis=1) \
+                           for i in xrange(n_teach)]).T
     activation = np.where(activation**8 > 1)[0]
 
     idx        = [activation.min(), activation.max()+1]
@@ -206,12 +198,9 @@ if flag["reload"]:
     idx_spk[0] = np.argmin (np.abs(t_analog[idx[0]]-timev))
     idx_spk[1] = np.argmin (np.abs(t_analog[idx[1]]-timev))
     
-    # Store analog signals
-    X_train = np.array(map(lambda x: x[idx[0]:idx[1],:],X_train))
-    X_train = np.transpose (X_train, axes=[1,2,0])
-
-    X_test = np.array(map(lambda x: x[idx[0]:idx[1],:],X_test))
-    X_test = np.transpose (X_test, axes=[1,2,0])
+    # Store analog signals (views, already in [nT, n_neu, n_trials] layout)
+    X_train = X_train[idx[0]:idx[1],:,:]
+    X_test  = X_test[idx[0]:idx[1],:,:]
 
     nT = idx[1]-idx[0]
     T  = t_analog[idx[1]]-t_analog[idx[0]]
@@ -238,6 +227,7 @@ else:
 
 ## Reservoir
 res = L.Reservoir()
+res.rc.refit_policy = 'predict' # offline: solve once, at the first predict
 
 
 # Frequency scaling of teaching signal
@@ -283,6 +273,11 @@ for i in xrange(n_teach):
     fig2.canvas.draw()
     fig2.canvas.flush_events()
 
+print "#### LEAVE-ONE-TRIAL-OUT"
+rmse_loto = res.loto([(X_train[:,:,i], T_sig(t_analog,W_train[i,:])) \
+                      for i in xrange(n_teach)])[0]
+print "### RMSE leave-one-trial-out: ", np.mean(rmse_loto), "+-", np.std(rmse_loto)
+
 print "#### TESTING"
 fig3 = figure(3)
 
@@ -295,6 +290,7 @@ fig3.canvas.draw()
 fig3.canvas.flush_events()
 
 rmse_testings = []
+score_test    = scoring.ScoreAccumulator() # all the test trials pooled
 for i in range(n_test):
     print "Offline training on data point ",\
              i, " of ", n_test
@@ -307,11 +303,13 @@ for i in range(n_test):
     print "### RMSE test",i,": ", rmse
 
     rmse_testings.append(rmse)
+    score_test.update(zh["output"], targ)
 
     ax3[i].plot(t_analog,zh["output"])
     ax3[i].plot(t_analog,targ)
     fig3.canvas.draw()
     fig3.canvas.flush_events()
+print "### RMSE test, all trials: ", score_test.nrmse()
 
 
 #order wx as ... just to check cmap=plt.cm.get_cmap('jet'),
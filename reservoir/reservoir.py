@@ -36,13 +36,21 @@ import matplotlib
 from pylab import *
 from sklearn.linear_model import RidgeCV
 from sklearn import metrics
-from scipy.stats import pearsonr
 
 import pdb
 import multiprocessing as mpi
+import sys
+sys.path.append('../')
+import spk2sig
+import spikes
+import readout
+import scoring
+import inference
+from spk2sig import ts2trace, Ts2SigStream, ts2sig_stream, ts2sig_trials, \
+                    ts2sig_parallel, Gaussian, ts2counts
 
 class Reservoir:
-    def __init__(self, population=None,  cee=0.5, cii=0.3,nx=16,ny=16):
+    def __init__(self, population=None,  cee=0.5, cii=0.3,nx=16,ny=16, processes=None):
         ### ========================= define what is needed to program the chip ====
         self.shape = (nx,ny);
         self.Nn    = np.prod(self.shape);
@@ -55,19 +63,19 @@ class Reservoir:
         self.matrix_programmable_exc_inh = np.zeros(Nn2)
         # end resources
         # resources for Reservoir Computing
-        self.CovMatrix  = {"input":np.zeros(Nn2),"output":np.zeros(Nn2)} # Covariance matrix of inputs and outputs
-        self.ReadoutW   = {"input":np.zeros([self.Nn,1]),"output":np.zeros([self.Nn,1])}     # Readout weights
-        self.ProjTeach  = {"input":np.zeros([self.Nn,1]),"output":np.zeros([self.Nn,1])}     # Teaching signal projected on inputs and outputs
-        alpha = np.logspace (-12,40,100) # Regularization parameters: 50 values
-        self._regressor = {"input":RidgeCV(alphas=alpha,normalize=True, fit_intercept=False), \
-                           "output":RidgeCV(alphas=alpha,normalize=True, fit_intercept=False)} # Linear regression with cross-validation
-        self.runningMean = {"input": 0, "output":0}
-        self.samples = 0
+        self.rc = readout.ReadoutState(self.Nn, alphas=np.logspace(-12,40,100), \
+                                       fit_intercept=False) # Readouts, see reset
+        self.CovMatrix   = self.rc.CovMatrix   # Covariance matrix of inputs and outputs
+        self.ReadoutW    = self.rc.ReadoutW    # Readout weights
+        self.ProjTeach   = self.rc.ProjTeach   # Teaching signal projected on inputs and outputs
+        self._regressor  = self.rc.regressor
         # end resources for RC
         # network parameters
         self.cee = cee
         self.cii = cii
         self.rcn = population
+        #parallel processing (e.g. ts2sig_parallel, ts2sig_trials)
+        self.p = mpi.Pool(processes=processes) if processes else None
         if population:
             self.setup = population.setup
             self.setup.chips['mn256r1'].load_parameters('biases/biases_default.biases')
@@ -355,7 +363,7 @@ class Reservoir:
 
         return stimulus, index_syn
 
-    def stimulate_reservoir(self, stimulus, neu_sync = 10,  trials=5):
+    def stimulate_reservoir(self, stimulus, neu_sync = 10,  trials=5, as_spikes=False):
         '''
         stimulate reservoir via virtual input synapses
         nsteps -> time steps to be considered in a duration = duration
@@ -363,6 +371,7 @@ class Reservoir:
         min_freq -> min input freq
         trials -> number of different stimulations with inhonogeneous poisson spike trains
         rate_matrix -> normalized rate matrix with dimensions [nsyn,timebins]
+        as_spikes -> return spikes.Spikes containers instead of [N,2] arrays
         '''
         duration = np.max(stimulus[1].raw_data()[:,0])-np.min(stimulus[1].raw_data()[:,0])+1000
         somach = self.rcn.soma.channel
@@ -371,6 +380,15 @@ class Reservoir:
         for this_stim in range(trials):
             out = self.setup.stimulate(stimulus, send_reset_event=False, duration=duration)
             out = out[somach]
+            if as_spikes:
+                #sync data with the first spike of the sync neuron
+                out = spikes.from_raw(out.raw_data())
+                start_time = out.neuron(neu_sync)[0]
+                clean_data = out.window(start_time+1)
+                clean_data = clean_data.shift(-clean_data.t[0])
+                tot_outputs.append(clean_data)
+                tot_inputs.append(spikes.from_raw(stimulus[1].raw_data()))
+                continue
             #sync data with sync neuron
             raw_data = out.raw_data()
             sync_index = raw_data[:,1] == neu_sync
@@ -450,22 +468,12 @@ class Reservoir:
 
     def mean_neu_firing(self, spike_train, n_neurons,nbins=10):
         '''
-        return mean neu firing matrix
-        '''
-        simulation_time = [np.min(spike_train[:,0]),np.max(spike_train[:,0])]
-        un, bins = np.histogram(simulation_time,nbins)
-        mean_rate = np.zeros([len(n_neurons),nbins])
-        for b in range(nbins-1):
-            #simulation_time = [np.min(spike_train[0][:]), np.max(spike_train[0][:])]
-            for i in range(len(n_neurons)):
-                index_neu = np.where( \
-                              np.logical_and(spike_train[:,1] == n_neurons[i], \
-                                     np.logical_and(spike_train[:,0] > bins[b], \
-                                            spike_train[:,0] < bins[b+1] ) \
-                                            ) \
-                                    )
-                mean_rate[i,b] = len(index_neu[0])*1000.0/(bins[b+1]-bins[b]) # time unit: ms
-        return mean_rate
+        return mean neu firing matrix [len(n_neurons), nbins] in Hz
+        spike_train -> [N,2] raw data or spikes.Spikes (or a list of trials)
+        nbins -> number of bins, or bin edges in ms
+        (see spikes.firing_rates)
+        '''
+        return spikes.firing_rates(spike_train, n_neurons, bins=nbins, n_neu=self.Nn)
 
     def poke(self, stimulus):
         '''
@@ -481,70 +489,124 @@ class Reservoir:
         return inputs, outputs
             
 
-    def reset (self, alpha=np.logspace (-12,40,100)):
+    def reset (self, alpha=np.logspace (-12,40,100), dtype=np.float64, packed=False, \
+               refit_policy='trial', refit_every=10, refit_tol=1e-2, forget=1.0, \
+               window=None, per_target=False):
         '''
         reset reservoir
-        '''
-        self.CovMatrix  = {"input":np.zeros([self.Nn,self.Nn]),"output":np.zeros([self.Nn,self.Nn])} # Covariance matrix of inputs and outputs
-        self.ReadoutW   = {"input":np.zeros([self.Nn,1]),"output":np.zeros([self.Nn,1])}     # Readout weights
-        self.ProjTeach  = {"input":np.zeros([self.Nn,1]),"output":np.zeros([self.Nn,1])}     # Teaching signal projected on inputs and outputs
-        #alpha = np.logspace (-12,40,100) # Regularization parameters: 50 values
-        self._regressor = {"input":RidgeCV(alphas=alpha,normalize=True, fit_intercept=False), \
-                           "output":RidgeCV(alphas=alpha,normalize=True, fit_intercept=False)} # Linear regression with cross-validation
-        self.runningMean = {"input": 0, "output":0}
-        self.samples = 0
+        dtype, packed, refit_policy, refit_every, refit_tol, forget, window,
+        per_target -> settings of the readouts, see readout.ReadoutState
+        '''
+        self.rc = readout.ReadoutState(self.Nn, alpha, False, dtype, packed, \
+                                       refit_policy, refit_every, refit_tol, \
+                                       forget, window, per_target)
+        self.CovMatrix   = self.rc.CovMatrix   # Covariance matrix of inputs and outputs
+        self.ReadoutW    = self.rc.ReadoutW    # Readout weights
+        self.ProjTeach   = self.rc.ProjTeach   # Teaching signal projected on inputs and outputs
+        self._regressor  = self.rc.regressor
         
         print "RC storage reseted!"
 
-    def train(self, X, Yt=None, teach_sig=None):
+    def rls (self, forget = 1.0, alpha = None):
+        '''
+        Switches the readouts to recursive least squares (readout.RLS),
+        updated with every sample by train_rls. They start from the current
+        CovMatrix/ProjTeach state and predict like the ridge readouts.
+        reset goes back to the covariance path.
+        forget -> forgetting factor in (0, 1], 1 means no forgetting
+        alpha -> regularization, default the one of the last ridge fit
+        '''
+        self.rc.rls (forget, alpha)
+
+    def train(self, X, Yt=None, teach_sig=None, mix=None):
         '''
         Regression of teach_sig using inputs (Yt) and outputs (X)
+        X, Yt -> dense or scipy.sparse (e.g. ts2counts) [nT, Nn]
+        mix -> unique targets, see readout.ReadoutState.unique_targets
+        '''
+        data = {"output": X}
+        if Yt is not None:
+            data["input"] = Yt
+        self.rc.learn (data, teach_sig, mix)
+
+    def train_spikes(self, t, sigma, X, Yt=None, teach_sig=None, cutoff=None, mix=None):
+        '''
+        Same as train for the gaussian membrane of width sigma sampled at t,
+        but the statistics are computed straight from the output (X) and
+        input (Yt) spikes, spikes.Spikes or [N,2] raw data (see
+        spk2sig.gauss_stats). The analog signals are never built.
+        mix -> unique targets, see readout.ReadoutState.unique_targets
+        '''
+        teach_sig = self.rc.unique_targets (teach_sig, mix)
+        stats = {}
+        for key, s in (("output", X), ("input", Yt)):
+            if s is None:
+                continue
+            if not isinstance(s, spikes.Spikes):
+                s = spikes.from_raw(s, self.Nn)
+            C, Z, nT, S = spk2sig.gauss_stats(t, sigma, s, None, teach_sig, \
+                                           n_neu=self.Nn, cutoff=cutoff)
+            stats[key] = (C, Z, S) + readout.target_sums (teach_sig)
+        self.rc.learn_stats (stats, nT)
+
+    def train_rls(self, X, Yt=None, teach_sig=None, mix=None):
+        '''
+        Per sample update of the RLS readouts (see rls) with the frames of
+        outputs (X) and inputs (Yt), e.g. straight from Ts2SigStream.
+        X, Yt -> dense or scipy.sparse [nT, Nn]
+        mix -> unique targets, see readout.ReadoutState.unique_targets
+        '''
+        data = {"output": X}
+        if Yt is not None:
+            data["input"] = Yt
+        self.rc.rls_learn (data, teach_sig, mix)
+
+    def refit (self):
+        '''
+        Solves the readouts with the statistics accumulated so far.
+        '''
+        self.rc.solve ()
+
+    def save_stats (self, filename):
+        '''
+        Saves the readout statistics, see readout.ReadoutState.save_stats.
         '''
-        #inits
-        nT,Nn        = np.shape(X)
-        nTtot        = self.samples + nT
-        w            = (self.samples/nTtot, 1.0/nTtot)      
-        # Covariance matrix
-        Cx = np.dot (X.T, X) # output
-        # Projection of data
-        Zx = np.dot (X.T, teach_sig) #output
-        # Update cov matrix
-        #raise Exception
-        self.CovMatrix["output"]  = \
-                    w[0]*self.CovMatrix["output"] + w[1]*Cx
-        self.ProjTeach["output"]  = \
-                    w[0]*self.ProjTeach["output"] + w[1]*Zx
-        # Update weights
-        self._regressor["output"].fit(self.CovMatrix["output"],\
-                                      self.ProjTeach["output"])
-        self.ReadoutW["output"] = self._regressor["output"].coef_.T
-
-        if Yt:
-            C  = np.dot (Yt.T, Yt) # input
-            Z  = np.dot (Yt.T, teach_sig) # input
-            self.CovMatrix["input"]  = \
-                    w[0]*self.CovMatrix["input"] + w[1]*C
-            self.ProjTeach["input"]  = \
-                    w[0]*self.ProjTeach["input"] + w[1]*Z
-            # Update weights
-            self._regressor["input"].fit(self.CovMatrix["input"],\
-                                         self.ProjTeach["input"])
-            self.ReadoutW["input"]  = self._regressor["input"].coef_.T
-
-        # Update samples
-        self.samples = nTtot
+        self.rc.save_stats (filename)
+
+    def load_stats (self, filenames, merge = False):
+        '''
+        Loads readout statistics saved by save_stats (one file or a list, merged),
+        see readout.ReadoutState.load_stats.
+        '''
+        self.rc.load_stats (filenames, merge)
+
+    def loto (self, trials, alpha = None):
+        '''
+        Leave-one-trial-out evaluation of the output readout (see readout.loto),
+        trials is a list of (x, teach_sig). Returns the normalized RMSE of every
+        held-out trial, the held-out predictions and alpha (chosen within
+        every fold unless given).
+        '''
+        return self.rc.loto (trials, alpha)
+
+    def export (self, filename, key = "output", kernel = None):
+        '''
+        Exports the trained readout of key to a small file for deployment
+        (inference.save_readout): weights, intercept, active neurons and the
+        feature kernel (e.g. spk2sig.Gaussian or a dict of its parameters).
+        inference.load_readout gives a NumPy-only predictor.
+        '''
+        self.rc.export (filename, key, kernel)
 
     def predict (self, X, Yt=None,  initNt=0):
         '''
         X -> outputs
         Yt -> inputs
         '''
-        
-        Z ={"output": self._regressor["output"].predict(X[initNt::,:])}
-        if Yt:
-            Z["input"] = self._regressor["input"].predict(Yt[initNt::,:])
-
-        return Z
+        data = {"output": X[initNt::,:]}
+        if Yt is not None:
+            data["input"] = Yt[initNt::,:]
+        return self.rc.predict (data)
                            
     def create_stimuli_matrix (self, G, rates, nT, nx=16, ny=16) :
         '''
@@ -635,37 +697,13 @@ class Reservoir:
         return ret
 
     ### HELPER FUNCTIONS
-    def _realtime_learn (self, x, y, teach_sig):
+    def _realtime_learn (self, x, y, teach_sig, mix = None):
         '''
         Regression of teach_sig using inputs (x) and outputs (y).
+        x, y -> dense or scipy.sparse (e.g. ts2counts) [nT, Nn]
+        mix -> unique targets, see readout.ReadoutState.unique_targets
         '''
-        nT,Nn        = x.shape
-        nTtot        = self.samples + nT
-        w            = (self.samples/nTtot, 1.0/nTtot)
-
-        # Update mean
-        #self.runningMean["input"] = w[0]*self.runningMean["input"] + w[1]*np.sum(x,axis=0)
-        #self.runningMean["output"] = w[0]*self.runningMean["output"] + w[1]*np.sum(y,axis=0)
-        # Detrend data
-        #xx = x - self.runningMean["input"]
-        #yy = y - self.runningMean["output"]
-        # Covariance matrix
-        Cx = np.dot (x.T, x) # input
-        C  = np.dot (y.T, y) # output
-        # Projection of data
-        Zx = np.dot (x.T, teach_sig)
-        Z  = np.dot (y.T, teach_sig)
-        #print  "covdiff ", np.sum(np.abs(self.CovMatrix["input"]-Cx))/np.sum(np.abs(self.CovMatrix["input"]))
-        # Update cov matrix
-        self.CovMatrix["input"]   = w[0]*self.CovMatrix["input"] + w[1]*Cx
-        self.CovMatrix["output"]  = w[0]*self.CovMatrix["output"] + w[1]*C
-        self.ProjTeach["input"]   = w[0]*self.ProjTeach["input"] + w[1]*Zx
-        self.ProjTeach["output"]  = w[0]*self.ProjTeach["output"] + w[1]*Z
-        # Update weights
-        self._regressor["input"].fit(self.CovMatrix["input"], self.ProjTeach["input"])
-        self._regressor["output"].fit(self.CovMatrix["output"], self.ProjTeach["output"])
-        self.ReadoutW["input"]  = self._regressor["input"].coef_.T
-        self.ReadoutW["output"] = self._regressor["output"].coef_.T
+        self.rc.learn ({"input": x, "output": y}, teach_sig, mix)
 
         #self._regressor["input"].fit(x, teach_sig)
         #self._regressor["output"].fit(y, teach_sig)
@@ -676,9 +714,6 @@ class Reservoir:
         #    self.ReadoutW["input"]  = w[0]*self.ReadoutW["input"] + w[1]*self._regressor["input"].coef_.T
         #    self.ReadoutW["output"] = w[0]*self.ReadoutW["output"] + w[1]*self._regressor["output"].coef_.T
 
-        # Update samples
-        self.samples = nTtot
-
     #characterize neurons responses
     def measure_phy_neurons(self, max_freq= 1500, min_freq = 350, duration = 1000, nsteps = 5):
         '''
@@ -729,41 +764,39 @@ class Reservoir:
         
     def RC_score(self, zh, sig):
         '''
-        compare two signals
+        compare two signals: Pearson r and p-value of every column
+        ([nteach, 2]), all columns at once (see scoring.pearson)
         '''
-        #scores = np.sqrt(((zh - sig) ** 2).sum(axis=0)) / np.sqrt((sig** 2).sum(axis=0))
-        nT, nteach = np.shape(sig)
-        scores = np.zeros([nteach,2])
-        for i in range(nteach):
-            scores[i,:] = pearsonr(zh[:,i], sig[:,i])
-            
-        #nT, nteach = np.shape(sig)
-        #z = (zh-zh.mean(axis=0))/zh.std(axis=0)
-        #s = (sig-sig.mean(axis=0))/sig.std(axis=0)
-        #scores = np.dot(z.T,s).T / nT
-        
-        #scores = np.zeros([nteach,1])
-        #for ind,this_teach in enumerate(teach_sig.T):
-        #    sig  = np.dot(X,self._regressor[type_r].coef_[ind,:][:,None])+self._regressor[type_r].intercept_[ind]
-        #    sig = (sig - np.mean(sig))/np.std(sig) 
-        #    tt = np.copy(this_teach)
-        #    tt = (tt-np.mean(tt))/np.std(tt)
-        #    score = np.dot(sig.T,tt)  / nT
-        #    scores[ind,:] = score
-            
-        return scores
+        r, p = scoring.pearson (zh, sig)
+        return np.column_stack ((r, p))
 
-def ts2sig (t, func, ts, n_id, n_neu = 256):
+def ts2sig (t, func, ts, n_id, n_neu = 256, method = 'dense', **kwargs):
     '''
     t -> time vector
     func -> time basis f(t,ts)
-    ts - > time stamp of spikes
+    ts - > time stamp of spikes (or a spikes.Spikes, then n_id is None)
     n_id -> neuron id
+    method -> 'dense' evaluates func for every spike and time sample
+              'fft' bins the spikes and convolves (see spk2sig.ts2sig_fft)
+              'window' evaluates func only within a radius of each spike,
+                       needs radius=... (see spk2sig.ts2sig_window)
+    kwargs -> passed to the chosen method
     '''
+    if method == 'fft':
+        return spk2sig.ts2sig_fft(t, func, ts, n_id, n_neu=n_neu, **kwargs)
+    elif method == 'window':
+        return spk2sig.ts2sig_window(t, func, ts, n_id, n_neu=n_neu, **kwargs)
+    elif method != 'dense':
+        raise ValueError ('unknown ts2sig method: '+str(method))
     nT = len(t)
+    Y = np.zeros([nT,n_neu])
+    if isinstance(ts, spikes.Spikes):
+        # per neuron slices of the container index
+        for i in ts.active():
+            Y[:,i] = np.sum(func(t[:,None],ts.neuron(i)/1e3), axis=1)
+        return Y
     nid = map(int,np.unique(n_id))
     nS = len(nid)
-    Y = np.zeros([nT,n_neu])
     tot_exponent = []
     for i in xrange(nS):
         idx = np.where(n_id == nid[i])[0]
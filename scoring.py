@@ -0,0 +1,166 @@
+'''
+ Copyright (C) 2014 - Federico Corradi
+ Copyright (C) 2014 - Juan Pablo Carbajal
+
+ This progrm is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+############### author ##########
+# federico corradi
+# federico@ini.phys.ethz.ch
+# Juan Pablo Carbajal
+# ajuanpi+dev@gmail.com
+#
+# Scores of the readout predictions
+# ===============================
+from __future__ import division
+import numpy as np
+from scipy import special
+
+def _moments (zh, sig):
+    # centered cross and auto sums over time (axis 0), one pass
+    zh  = np.asarray(zh, dtype=float)
+    sig = np.asarray(sig, dtype=float)
+    zc  = zh - np.mean(zh, axis=0)
+    sc  = sig - np.mean(sig, axis=0)
+    return np.sum(zc*sc, axis=0), np.sum(zc**2, axis=0), np.sum(sc**2, axis=0)
+
+def pearson (zh, sig):
+    '''
+    Pearson correlation and two-sided p-value (as scipy.stats.pearsonr) of
+    every column of the prediction zh with the same column of sig.
+    zh, sig -> [nT, n_teach] or [nT, n_teach, n_trials], time along axis 0
+    Returns r and p of shape [n_teach] or [n_teach, n_trials].
+    '''
+    szs, szz, sss = _moments(zh, sig)
+    return _pearson (szs, szz, sss, np.shape(sig)[0])
+
+def _pearson (szs, szz, sss, n):
+    # r and p-value from the centered sums of n samples
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r  = np.clip(szs / np.sqrt(szz*sss), -1, 1)
+        df = n - 2
+        t2 = r**2 * df / ((1 - r) * (1 + r))
+        p  = special.betainc(0.5*df, 0.5, df / (df + t2))
+    return r, p
+
+def rmse (ideal, measured):
+    '''
+    Root mean square error of every column (mean over time, axis 0).
+    '''
+    ideal = np.asarray(ideal, dtype=float)
+    return np.sqrt(np.mean((ideal - np.asarray(measured))**2, axis=0))
+
+def nrmse (ideal, measured):
+    '''
+    RMSE of every column normalized by the RMS of ideal, as
+    root_mean_square(ideal, measured, norm=True) of a single column.
+    '''
+    ideal = np.asarray(ideal, dtype=float)
+    return rmse(ideal, measured) / np.sqrt(np.mean(ideal**2, axis=0))
+
+def scores (zh, sig):
+    '''
+    All the scores of every column (and trial) of the prediction zh
+    against sig: {"r", "p", "rmse", "nrmse"}, see pearson.
+    '''
+    r, p = pearson (zh, sig)
+    return {"r": r, "p": p, "rmse": rmse(sig, zh), "nrmse": nrmse(sig, zh)}
+
+class ScoreAccumulator:
+    '''
+    Streaming scores of every target column: MSE, RMSE, NRMSE and Pearson r
+    (with p-value), equal to those of all the samples seen at once. It is
+    updated with chunks of predictions and targets in O(chunk) time and
+    keeps only O(n_teach) sums, so no prediction history is stored.
+    Accumulators of different trials or workers merge exactly (centered
+    sums combined as in Chan et al.).
+
+    acc = ScoreAccumulator()
+    for zh, sig in chunks:
+        acc.update(zh, sig)
+    acc.nrmse(), acc.pearson()
+    '''
+    def __init__(self):
+        self.n   = 0
+        self.zm  = 0.0 # means of prediction and target
+        self.sm  = 0.0
+        self.szs = 0.0 # centered cross and auto sums
+        self.szz = 0.0
+        self.sss = 0.0
+        self.see = 0.0 # sum of squared errors
+        self.ssq = 0.0 # sum of squared targets
+
+    def update(self, zh, sig):
+        '''
+        zh, sig -> prediction and target chunk [nT, n_teach] (or [nT])
+        '''
+        zh  = np.asarray(zh, dtype=float)
+        sig = np.asarray(sig, dtype=float)
+        if len(sig) == 0:
+            return self
+        c = ScoreAccumulator()
+        c.n   = len(sig)
+        c.zm  = np.mean(zh, axis=0)
+        c.sm  = np.mean(sig, axis=0)
+        c.szs, c.szz, c.sss = _moments(zh, sig)
+        c.see = np.sum((zh - sig)**2, axis=0)
+        c.ssq = np.sum(sig**2, axis=0)
+        return self.merge (c)
+
+    def merge(self, other):
+        '''
+        Adds the samples of another accumulator.
+        '''
+        if other.n == 0:
+            return self
+        n  = self.n + other.n
+        w  = self.n * other.n / n
+        dz = other.zm - self.zm
+        ds = other.sm - self.sm
+        self.szs = self.szs + other.szs + w*dz*ds
+        self.szz = self.szz + other.szz + w*dz**2
+        self.sss = self.sss + other.sss + w*ds**2
+        self.zm  = self.zm + dz*other.n/n
+        self.sm  = self.sm + ds*other.n/n
+        self.see = self.see + other.see
+        self.ssq = self.ssq + other.ssq
+        self.n   = n
+        return self
+
+    def mse(self):
+        return self.see / self.n
+
+    def rmse(self):
+        return np.sqrt (self.mse())
+
+    def nrmse(self):
+        '''
+        RMSE normalized by the RMS of the target, as nrmse.
+        '''
+        return np.sqrt (self.see / self.ssq)
+
+    def pearson(self):
+        '''
+        Pearson r and p-value, as pearson.
+        '''
+        return _pearson (self.szs, self.szz, self.sss, self.n)
+
+    def scores(self):
+        '''
+        {"r", "p", "rmse", "nrmse"} as scores.
+        '''
+        r, p = self.pearson ()
+        return {"r": r, "p": p, "rmse": self.rmse(), "nrmse": self.nrmse()}
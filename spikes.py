@@ -0,0 +1,190 @@
+'''
+ Copyright (C) 2014 - Federico Corradi
+ Copyright (C) 2014 - Juan Pablo Carbajal
+
+ This progrm is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+############### author ##########
+# federico corradi
+# federico@ini.phys.ethz.ch
+# Juan Pablo Carbajal
+# ajuanpi+dev@gmail.com
+#
+# Spike containers
+# ===============================
+from __future__ import division
+import numpy as np
+
+class Spikes:
+    '''
+    Spikes of a population, stored by columns: integer time stamps in
+    microseconds (int64) and integer neuron ids (int32), sorted by time.
+    The index by neuron (CSR: indptr + times grouped by neuron) is built the
+    first time it is needed and reused afterwards.
+
+    s = from_raw(out.raw_data())   # [N,2] array, times in ms
+    s.neuron(10)                   # times of neuron 10 (view, O(1))
+    s.window(t0, t1)               # spikes with t0 <= t < t1 (view)
+    '''
+    def __init__(self, t, n_id, n_neu = 256, sort = True):
+        '''
+        t -> time stamps in microseconds
+        n_id -> neuron ids
+        n_neu -> number of neurons (ids are 0..n_neu-1)
+        sort -> set to False if t is already sorted
+        '''
+        t    = np.asarray(t, dtype=np.int64).ravel()
+        n_id = np.asarray(n_id, dtype=np.int32).ravel()
+        if sort:
+            order = np.argsort (t, kind='mergesort')
+            t     = t[order]
+            n_id  = n_id[order]
+        self.t      = t
+        self.n_id   = n_id
+        self.n_neu  = n_neu
+        self._indptr  = None
+        self._t_neu   = None
+
+    def __len__(self):
+        return len(self.t)
+
+    def ts(self):
+        '''
+        Time stamps in milliseconds (the units of raw_data and ts2sig).
+        '''
+        return self.t / 1e3
+
+    def raw(self):
+        '''
+        [N,2] float array like raw_data(): times in ms and neuron ids.
+        '''
+        return np.column_stack ((self.ts(), self.n_id))
+
+    def index(self):
+        '''
+        CSR index by neuron: the times of neuron i are
+        t_neu[indptr[i]:indptr[i+1]], sorted.
+        '''
+        if self._indptr is None:
+            order = np.argsort (self.n_id, kind='mergesort') # keeps time order
+            count = np.bincount (self.n_id, minlength=self.n_neu)
+            self._indptr = np.concatenate (([0], np.cumsum(count)))
+            self._t_neu  = self.t[order]
+        return self._indptr, self._t_neu
+
+    def neuron(self, i):
+        '''
+        Time stamps (us) of neuron i.
+        '''
+        indptr, t_neu = self.index()
+        return t_neu[indptr[i]:indptr[i+1]]
+
+    def counts(self):
+        '''
+        Number of spikes of every neuron.
+        '''
+        return np.diff (self.index()[0])
+
+    def active(self):
+        '''
+        Ids of the neurons that spiked.
+        '''
+        return np.where (self.counts() > 0)[0]
+
+    def window(self, t0 = None, t1 = None):
+        '''
+        Spikes with t0 <= t < t1 (us), None means unbounded.
+        '''
+        lo = 0 if t0 is None else np.searchsorted (self.t, t0, side='left')
+        hi = len(self.t) if t1 is None else np.searchsorted (self.t, t1, side='left')
+        return Spikes(self.t[lo:hi], self.n_id[lo:hi], self.n_neu, sort=False)
+
+    def shift(self, dt):
+        '''
+        Spikes delayed by dt (us).
+        '''
+        return Spikes(self.t + int(dt), self.n_id, self.n_neu, sort=False)
+
+    def merge(self, other):
+        '''
+        Spikes of both containers, sorted by time (self first on ties).
+        '''
+        pos  = np.searchsorted (self.t, other.t, side='right') + np.arange(len(other.t))
+        mask = np.ones (len(self.t) + len(other.t), dtype=bool)
+        mask[pos] = False
+        t    = np.empty (len(mask), dtype=np.int64)
+        n_id = np.empty (len(mask), dtype=np.int32)
+        t[pos], n_id[pos]   = other.t, other.n_id
+        t[mask], n_id[mask] = self.t, self.n_id
+        return Spikes(t, n_id, max(self.n_neu, other.n_neu), sort=False)
+
+def from_raw (raw, n_neu = 256):
+    '''
+    Spikes from a [N,2] raw_data() array (times in ms, neuron ids).
+    '''
+    raw = np.atleast_2d(raw)
+    return Spikes(np.round(raw[:,0]*1e3), raw[:,1], n_neu)
+
+def as_arrays (ts, n_id = None):
+    '''
+    Returns time stamps (ms) and neuron ids of either a Spikes container
+    (n_id is ignored) or of the two arrays.
+    '''
+    if isinstance (ts, Spikes):
+        return ts.ts(), ts.n_id
+    return np.ravel(ts), np.ravel(n_id).astype(int)
+
+def firing_rates (spike_train, n_neurons = None, bins = 10, n_neu = 256):
+    '''
+    Mean firing rate matrix [len(n_neurons), nbins] in Hz (times in ms),
+    computed in a single 2-D histogram pass over the spikes.
+    spike_train -> Spikes, [N,2] raw data, or a list of them (trials), then
+                   the output is [len(n_neurons), nbins, n_trials]
+    n_neurons -> neuron ids (rows), default all n_neu neurons
+    bins -> number of bins spanning the spikes of each trial, or the bin
+            edges in ms (common to all trials)
+    Bins are half open [e_k, e_k+1) except the last one, which is closed.
+    '''
+    if isinstance (spike_train, list):
+        return np.dstack ([firing_rates(s, n_neurons, bins, n_neu) \
+                           for s in spike_train])
+    if isinstance (spike_train, Spikes):
+        ts, n_id = as_arrays(spike_train)
+    else:
+        spike_train = np.atleast_2d(spike_train)
+        ts, n_id = as_arrays(spike_train[:,0], spike_train[:,1])
+    if n_neurons is None:
+        n_neurons = np.arange(n_neu)
+    neu, rows = np.unique(np.asarray(n_neurons, dtype=int), return_inverse=True)
+    if np.ndim(bins) == 0:
+        if len(ts) > 0:
+            edges = np.linspace(np.min(ts), np.max(ts), int(bins)+1)
+        else:
+            edges = np.linspace(0, 1, int(bins)+1)
+    else:
+        edges = np.asarray(bins, dtype=float)
+    nb = len(edges) - 1
+
+    # row of each spike (-1: neuron not requested)
+    lut = -np.ones(max(np.max(neu), np.max(n_id) if len(n_id) else 0)+1, dtype=int)
+    lut[neu] = np.arange(len(neu))
+    r = lut[n_id]
+    b = np.searchsorted(edges, ts, side='right') - 1
+    b[ts == edges[-1]] = nb - 1
+    keep  = np.logical_and(r >= 0, np.logical_and(b >= 0, b < nb))
+    count = np.bincount(r[keep]*nb + b[keep], minlength=len(neu)*nb)
+    rate  = count.reshape([len(neu),nb]) * 1000.0 / np.diff(edges) # time unit: ms
+    return rate[rows]
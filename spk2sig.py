@@ -0,0 +1,525 @@
+'''
+ Copyright (C) 2014 - Federico Corradi
+ Copyright (C) 2014 - Juan Pablo Carbajal
+
+ This progrm is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+############### author ##########
+# federico corradi
+# federico@ini.phys.ethz.ch
+# Juan Pablo Carbajal
+# ajuanpi+dev@gmail.com
+#
+# Spikes to analog signals converters
+# ===============================
+from __future__ import division
+import os
+import tempfile
+import multiprocessing as mpi
+import numpy as np
+from scipy import sparse
+from spikes import Spikes, as_arrays
+
+def _uniform_step (t):
+    '''
+    Returns the sampling step of t, fails if t is not uniformly sampled.
+    '''
+    nT = len(t)
+    if nT < 2:
+        raise ValueError ('the time vector needs at least two samples')
+    dt = (t[-1] - t[0]) / (nT - 1)
+    if dt <= 0 or not np.allclose (np.diff(t), dt, rtol=1e-6, atol=0):
+        raise ValueError ('the time vector must be uniformly sampled')
+    return dt
+
+def _output (out, nT, n_neu):
+    '''
+    Zeroed [nT, n_neu] output, in out if given.
+    '''
+    if out is None:
+        return np.zeros([nT,n_neu])
+    if out.shape != (nT,n_neu):
+        raise ValueError ('out must have shape '+str((nT,n_neu)))
+    out[...] = 0
+    return out
+
+def ts2sig_fft (t, func, ts, n_id, n_neu = 256, oversample = 8, out = None):
+    '''
+    Same output as ts2sig, computed with FFTs.
+    Spikes are binned on a grid oversample times finer than t and the
+    histogram of each neuron is convolved with the sampled kernel.
+    t -> time vector (uniformly sampled)
+    func -> time basis f(t,ts), must depend only on t-ts
+    ts - > time stamp of spikes (or a spikes.Spikes, then n_id is None)
+    n_id -> neuron id
+    oversample -> refinement of the binning grid
+    out -> optional [nT, n_neu] array to write the result into
+
+    Each spike is split linearly between its two neighbouring grid points,
+    i.e. the kernel is linearly interpolated between samples dx apart,
+    dx = (t[1]-t[0])/oversample. The error per spike is bounded by
+    dx**2/8 * max|f''|, for the gaussian membrane of width sigma that is
+    dx**2/(8*sigma**2): with t sampled at sigma/2 (as in the experiment
+    scripts) and oversample = 8 the error is below 5e-4 per spike, and
+    below 5e-4 of the peak of the resulting signal.
+    Cost is O(oversample * (nT + T_spk) log(nT + T_spk) * n_neu), T_spk the
+    number of samples spanned by the spikes, independent of the number of
+    spikes.
+    '''
+    t  = np.ravel(t)
+    nT = len(t)
+    Y  = _output (out, nT, n_neu)
+    ts, n_id = as_arrays(ts, n_id)
+    if len(ts) == 0:
+        return Y
+    nid, n_id = np.unique(n_id, return_inverse=True)
+    nS = len(nid)
+    q  = int(oversample)
+    dx = _uniform_step(t) / q
+
+    # Linear binning on the fine grid
+    u  = (ts - t[0]) / dx
+    m0 = np.floor(u).astype(int)
+    a  = u - m0
+    f  = np.concatenate ((m0, m0+1))
+    wf = np.concatenate ((1-a, a))
+    nf = np.concatenate ((n_id, n_id))  # only neurons that spiked
+
+    # Polyphase split: fine index f = q*c + r
+    c  = f // q
+    r  = f - q*c
+    c0 = min (np.min(c), 0)
+    c1 = max (np.max(c), nT-1)
+    Nc = c1 - c0 + 1
+    H  = np.bincount ((r*Nc + c-c0)*nS + nf, weights=wf, \
+                      minlength=q*Nc*nS).reshape([q,Nc,nS])
+
+    # Coarse lags needed for the output samples
+    Lk   = nT + Nc - 1
+    lag  = np.arange(Lk) - c1
+    nfft = int(2**np.ceil(np.log2(Lk)))
+    S    = 0
+    for i in xrange(q):
+        k  = np.ravel(func((q*lag - i)*dx, 0.0))
+        S  = S + np.fft.rfft(H[i], nfft, axis=0) * np.fft.rfft(k, nfft)[:,None]
+    Y[:,nid] = np.fft.irfft(S, nfft, axis=0)[Nc-1:Nc-1+nT,:]
+    return Y
+
+def _window_rows (lo, cnt, chunk = 2**20):
+    '''
+    Enumerates the rows lo[k], .., lo[k]+cnt[k]-1 of every spike k, by
+    chunks of spikes with at most ~chunk rows each. Yields the index arrays
+    (spk, rows) of every chunk, one entry per (spike, row) pair.
+    '''
+    edges = np.searchsorted (np.cumsum(cnt), np.arange(chunk, np.sum(cnt), chunk))
+    edges = np.unique (np.concatenate (([0], edges, [len(cnt)])))
+    for b,e in zip(edges[:-1],edges[1:]):
+        n   = cnt[b:e]
+        tot = np.sum(n)
+        if tot == 0:
+            continue
+        spk  = np.repeat (np.arange(b,e), n)
+        rows = np.arange(tot) - np.repeat (np.cumsum(n) - n, n) + lo[spk]
+        yield spk, rows
+
+def _window_add (Y, t, func, ts, n_id, radius, offset = 0, chunk = 2**20):
+    '''
+    Adds to Y the contribution of each spike on the samples of t within
+    radius of it, row k of Y holds sample t[k+offset].
+    Contributions are added spike after spike (np.add.at), so the result
+    does not depend on how the spikes are split between calls.
+    '''
+    lo  = np.searchsorted (t, ts - radius, side='left')
+    hi  = np.searchsorted (t, ts + radius, side='right')
+    for spk, rows in _window_rows (lo, hi - lo, chunk):
+        val  = np.ravel (func(t[rows], ts[spk]))
+        np.add.at (Y, (rows - offset, n_id[spk]), val)
+    return Y
+
+def ts2sig_window (t, func, ts, n_id, radius, n_neu = 256, chunk = 2**20, \
+                   out = None):
+    '''
+    Same output as ts2sig for kernels with compact support.
+    Spikes are sorted by time and each one is evaluated only on the samples
+    of t within radius of it (found with searchsorted), so the cost is
+    O(n_spikes * radius/dt) instead of O(n_spikes * nT).
+    t -> time vector (sorted, not necessarily uniform)
+    func -> time basis f(t,ts), evaluated elementwise
+    ts - > time stamp of spikes (or a spikes.Spikes, then n_id is None)
+    n_id -> neuron id
+    radius -> func is taken as zero for |t-ts| > radius
+              e.g. 5*sigma for the gaussian membrane (error < 4e-6 per spike)
+    chunk -> maximum number of kernel evaluations held in memory at once
+    out -> optional [nT, n_neu] array to write the result into
+    '''
+    t  = np.ravel(t)
+    Y  = _output (out, len(t), n_neu)
+    if isinstance (ts, Spikes):
+        ts, n_id = as_arrays(ts)    # already sorted
+    else:
+        ts, n_id = as_arrays(ts, n_id)
+        order = np.argsort (ts, kind='mergesort')
+        ts, n_id = ts[order], n_id[order]
+    return _window_add (Y, t, func, ts, n_id, radius, chunk=chunk)
+
+def ts2trace (t, tau, ts, n_id, n_neu = 256, out = None):
+    '''
+    Causal exponential synaptic trace of the spikes sampled at t
+        y_i(t) = sum_{ts <= t} exp(-(t-ts)/tau)
+    for the spikes ts of neuron i. Each sample is obtained from the
+    previous one by a per-neuron recursive filter, cost O(n_spikes + nT).
+    Future spikes are never used, so it can run online.
+    t -> time vector (sorted, not necessarily uniform)
+    tau -> time constant of the trace (same units as t)
+    ts - > time stamp of spikes (or a spikes.Spikes, then n_id is None)
+    n_id -> neuron id
+    out -> optional [nT, n_neu] array to write the result into
+    Output has the ts2sig layout [nT, n_neu].
+    '''
+    t  = np.ravel(t)
+    nT = len(t)
+    Y  = _output (out, nT, n_neu)
+    ts, n_id = as_arrays(ts, n_id)
+    # Each spike jumps in at the first sample at or after it
+    k    = np.searchsorted (t, ts, side='left')
+    keep = k < nT
+    k    = k[keep]
+    np.add.at (Y, (k, n_id[keep]), np.exp(-(t[k] - ts[keep])/tau))
+    decay = np.exp(-np.diff(t)/tau)
+    for i in xrange(1,nT):
+        Y[i] += decay[i-1]*Y[i-1]
+    return Y
+
+class Ts2SigStream:
+    '''
+    Stateful ts2sig for spikes arriving in batches, e.g. while the chip is
+    being stimulated. Kernel tails are carried across batches and frames
+    (rows of the ts2sig output) are returned as soon as no future spike can
+    change them. Once flushed, the concatenated frames are identical to
+    ts2sig_window(t, func, ts, n_id, radius) on all the spikes, provided the
+    batches come in time order.
+
+    conv = Ts2SigStream(t, func, radius)
+    for ts, n_id in batches:
+        Y = conv.push(ts, n_id)   # finished frames, may be empty
+    Y = conv.flush()              # remaining frames
+    '''
+    def __init__(self, t, func, radius, n_neu = 256):
+        self.t      = np.ravel(t)
+        self.func   = func
+        self.radius = radius
+        self.n_neu  = n_neu
+        self.reset()
+
+    def reset(self):
+        self.done = 0                           # frames already returned
+        self.now  = -np.inf                     # all spikes up to now were pushed
+        self._buf = np.zeros([0,self.n_neu])    # frames done, done+1, ...
+
+    def push(self, ts, n_id, t_now = None):
+        '''
+        ts - > time stamp of spikes, not older than previous batches
+              (or a spikes.Spikes, then n_id is None)
+        n_id -> neuron id
+        t_now -> no spike older than t_now will be pushed anymore
+                 (default: the last spike of this batch)
+        Returns the frames finished by this batch, [n_frames, n_neu].
+        '''
+        ts, n_id = as_arrays(ts, n_id)
+        if len(ts) > 0:
+            if np.min(ts) < self.now:
+                raise ValueError ('spikes are older than a previous batch')
+            order = np.argsort (ts, kind='mergesort')
+            ts, n_id = ts[order], n_id[order]
+            hi    = np.searchsorted (self.t, ts[-1] + self.radius, side='right')
+            grow  = hi - self.done - self._buf.shape[0]
+            if grow > 0:
+                self._buf = np.vstack ((self._buf, np.zeros([grow,self.n_neu])))
+            _window_add (self._buf, self.t, self.func, ts, n_id, self.radius, \
+                         offset=self.done)
+            self.now = max (self.now, ts[-1])
+        if t_now is not None:
+            self.now = max (self.now, t_now)
+        return self._emit (np.searchsorted (self.t, self.now - self.radius, side='left'))
+
+    def flush(self):
+        '''
+        Returns all the remaining frames (no more spikes are expected).
+        '''
+        self.now = np.inf
+        return self._emit (len(self.t))
+
+    def _emit(self, k):
+        n = max (k - self.done, 0)
+        Y = np.zeros([n,self.n_neu])
+        m = min (n, self._buf.shape[0])
+        Y[:m] = self._buf[:m]
+        self._buf  = self._buf[m:].copy()
+        self.done += n
+        return Y
+
+def ts2sig_stream (t, func, radius, batches, n_neu = 256):
+    '''
+    Generator over Ts2SigStream: for each (ts, n_id) in batches yields the
+    finished frames, in order starting at t[0], and the remaining frames at
+    the end.
+    '''
+    conv = Ts2SigStream(t, func, radius, n_neu=n_neu)
+    for ts, n_id in batches:
+        yield conv.push(ts, n_id)
+    yield conv.flush()
+
+class Gaussian:
+    '''
+    Gaussian membrane exp(-(t-ts)**2/(2*sigma**2)), the kernel of the
+    experiment scripts. Unlike a lambda it can be pickled and sent to worker
+    processes.
+    '''
+    def __init__(self, sigma):
+        self.sigma = sigma
+
+    def __call__(self, t, ts):
+        return np.atleast_2d(np.exp((-(t-ts)**2)/(2*self.sigma**2)))
+
+    def radius(self, tol = 1e-6):
+        '''
+        Distance beyond which the kernel is below tol.
+        '''
+        return self.sigma*np.sqrt(-2*np.log(tol))
+
+_converters = {"window": ts2sig_window, "fft": ts2sig_fft}
+
+def _shared_file ():
+    '''
+    Name of a new temporary .npy file, in shared memory when available.
+    '''
+    shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, filename = tempfile.mkstemp (suffix='.npy', prefix='ts2sig_', dir=shm)
+    os.close(fd)
+    return filename
+
+def _convert_job (job):
+    '''
+    Pool worker: converts one trial, or one block of neurons lo:hi, straight
+    into the memory mapped output so nothing is pickled back.
+    '''
+    filename, i, lo, hi, t, func, ts, n_id, method, kwargs = job
+    out = np.load (filename, mmap_mode='r+')
+    Y   = out[:,lo:hi] if i is None else out[:,lo:hi,i]
+    _converters[method](t, func, ts, n_id, n_neu=hi-lo, out=Y, **kwargs)
+    out.flush()
+    del Y, out
+    return i
+
+def ts2sig_parallel (t, func, ts, n_id, n_neu = 256, pool = None, \
+                     processes = None, n_blocks = 16, method = 'window', \
+                     **kwargs):
+    '''
+    ts2sig_window/ts2sig_fft split over blocks of neurons on a worker pool
+    (cf. mFiles/ts2sig_v2.m). Workers write into a shared memory mapped
+    buffer, results are not pickled back.
+    pool -> multiprocessing pool, e.g. Lsm.p (a new one with processes
+            workers is created if None)
+    n_blocks -> number of neuron blocks (jobs)
+    method, kwargs -> as in ts2sig_trials
+    func must be picklable: use e.g. Gaussian(sigma) instead of a lambda.
+    '''
+    if method not in _converters:
+        raise ValueError ('unknown ts2sig method: '+str(method))
+    t    = np.ravel(t)
+    ts, n_id = as_arrays(ts, n_id)
+    filename = _shared_file()
+    out = np.lib.format.open_memmap (filename, mode='w+', dtype=np.float64, \
+                                     shape=(len(t), n_neu))
+    edges = np.unique (np.linspace(0, n_neu, n_blocks+1).astype(int))
+    jobs  = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        idx = np.where (np.logical_and (n_id >= lo, n_id < hi))[0]
+        jobs.append ((filename, None, lo, hi, t, func, ts[idx], n_id[idx]-lo, \
+                      method, kwargs))
+    own = pool is None
+    if own:
+        pool = mpi.Pool (processes=processes)
+    try:
+        pool.map (_convert_job, jobs)
+    finally:
+        if own:
+            pool.close()
+            pool.join()
+        os.remove (filename)    # the mapping stays valid
+    return np.asarray(out)
+
+def ts2sig_trials (t, func, trials, n_neu = 256, n_trials = None, out = None, \
+                   filename = None, method = 'window', pool = None, **kwargs):
+    '''
+    Converts several trials at once into a [nT, n_neu, n_trials] tensor,
+    the layout the training loops use (X_train[:,:,i]). Each trial is
+    written in place, no per-trial copies are made.
+    t -> time vector, common to all trials
+    func -> time basis f(t,ts)
+    trials -> sequence of (ts, n_id) (or of (Spikes, None)), or an iterable
+              if n_trials is given
+              (e.g. a generator loading the trial files one at a time)
+    out -> preallocated [nT, n_neu, n_trials] output
+    filename -> if given (and out is not) the output is a memory mapped
+                .npy file
+    method -> 'window' (needs radius=...) or 'fft'
+    pool -> multiprocessing pool (e.g. Lsm.p) to convert the trials in
+            parallel; the output is then a memory mapped file shared with
+            the workers (a temporary one if no filename is given), func
+            must be picklable (see Gaussian)
+    kwargs -> passed to ts2sig_window or ts2sig_fft
+    The tensor is Fortran ordered, so that each trial is contiguous.
+    '''
+    if method not in _converters:
+        raise ValueError ('unknown ts2sig method: '+str(method))
+    t  = np.ravel(t)
+    nT = len(t)
+    if n_trials is None:
+        n_trials = len(trials)
+    shape = (nT, n_neu, n_trials)
+    temp  = None
+    if out is None:
+        if filename is None and pool is not None:
+            filename = temp = _shared_file()
+        if filename is None:
+            out = np.zeros(shape, order='F')
+        else:
+            out = np.lib.format.open_memmap (filename, mode='w+', \
+                            dtype=np.float64, shape=shape, fortran_order=True)
+    elif out.shape != shape:
+        raise ValueError ('out must have shape '+str(shape))
+
+    def _jobs():
+        for i, (ts, n_id) in enumerate(trials):
+            if i >= n_trials:
+                raise ValueError ('more trials than n_trials')
+            yield i, ts, n_id
+
+    done = 0
+    try:
+        if pool is None:
+            for i, ts, n_id in _jobs():
+                _converters[method](t, func, ts, n_id, n_neu=n_neu, \
+                                    out=out[:,:,i], **kwargs)
+                done += 1
+        else:
+            if getattr(out, 'filename', None) is None:
+                raise ValueError ('with a pool out must be a memory mapped file')
+            out.flush()
+            jobs = ((out.filename, i, 0, n_neu, t, func, ts, n_id, method, \
+                     kwargs) for i, ts, n_id in _jobs())
+            for i in pool.imap_unordered (_convert_job, jobs):
+                done += 1
+    finally:
+        if temp is not None:
+            os.remove (temp)    # the mapping stays valid
+    if done != n_trials:
+        raise ValueError ('expected '+str(n_trials)+' trials, got '+str(done))
+    if temp is not None:
+        out = np.asarray(out)
+    return out
+
+def ts2counts (t, ts, n_id, n_neu = 256, func = None, radius = None):
+    '''
+    Sparse [nT, n_neu] matrix (scipy.sparse.csr_matrix) with the number of
+    spikes of each neuron at each sample of t (spikes go to the nearest
+    sample), optionally smoothed by a short kernel. For sparse activity it
+    replaces the dense ts2sig output as features of the readout, see
+    readout.gram and readout.project.
+    t -> time vector (sorted)
+    ts - > time stamp of spikes (or a spikes.Spikes, then n_id is None)
+    n_id -> neuron id
+    func, radius -> optional kernel f(t,ts) taken as zero beyond radius,
+                    the counts are then convolved with it (sample to sample)
+    '''
+    t  = np.ravel(t)
+    nT = len(t)
+    ts, n_id = as_arrays(ts, n_id)
+    half = np.diff(t) / 2
+    mid  = t[:-1] + half
+    lo   = t[0]  - (half[0]  if nT > 1 else 0)
+    hi   = t[-1] + (half[-1] if nT > 1 else 0)
+    keep = np.logical_and (ts >= lo, ts <= hi)
+    k    = np.searchsorted (mid, ts[keep], side='left')
+    X    = sparse.coo_matrix ((np.ones(len(k)), (k, n_id[keep])), \
+                              shape=(nT, n_neu)).tocsr()
+    if func is None:
+        return X
+    # banded smoothing matrix K[i,j] = f(t_i, t_j), |t_i - t_j| <= radius
+    a   = np.searchsorted (t, t - radius, side='left')
+    b   = np.searchsorted (t, t + radius, side='right')
+    n   = b - a
+    col = np.repeat (np.arange(nT), n)
+    row = np.arange(np.sum(n)) - np.repeat (np.cumsum(n) - n, n) + a[col]
+    K   = sparse.coo_matrix ((np.ravel(func(t[row], t[col])), (row, col)), \
+                             shape=(nT, nT)).tocsr()
+    return K.dot(X)
+
+def gauss_stats (t, sigma, ts, n_id, teach_sig = None, n_neu = 256, \
+                 cutoff = None, tol = 1e-6, chunk = 2**20):
+    '''
+    Readout statistics of the gaussian membrane signals computed straight
+    from the spike times, without building Y = ts2sig(t, Gaussian(sigma),..)
+        C = Y.T Y  [n_neu, n_neu],  Z = Y.T teach_sig  [n_neu, n_teach]
+    For a uniform t with step dt (dt <= sigma) the sum over samples of two
+    gaussians is, up to edge effects, their integral over dt, so
+        C[i,j] = sqrt(pi)*sigma/dt * sum exp(-(s-r)**2/(4*sigma**2))
+    over the spike pairs s of neuron i and r of neuron j. Only pairs closer
+    than cutoff are visited (sorted times + searchsorted), default where the
+    gaussian drops below tol. Spikes closer than a few sigma to the ends of
+    t lose part of their signal in Y, not in C.
+    Z is accumulated spike by spike over the samples within the kernel
+    radius. The column sums of Y are, likewise, S[i] = sqrt(2*pi)*sigma/dt
+    times the spike count of neuron i. Returns C, Z (None without
+    teach_sig), the number of samples and S, the statistics expected by
+    readout.ReadoutState.learn_stats.
+    '''
+    t  = np.ravel(t)
+    nT = len(t)
+    dt = _uniform_step(t)
+    ts, n_id = as_arrays(ts, n_id)
+    order = np.argsort (ts, kind='mergesort')
+    ts, n_id = ts[order], n_id[order]
+    if cutoff is None:
+        cutoff = 2*sigma*np.sqrt(-np.log(tol))
+    A = np.sqrt(np.pi)*sigma/dt
+
+    # spike pairs i < j with ts[j]-ts[i] <= cutoff
+    nS  = len(ts)
+    hi  = np.searchsorted (ts, ts + cutoff, side='right')
+    M   = np.zeros (n_neu*n_neu)
+    for i, j in _window_rows (np.arange(nS) + 1, hi - np.arange(nS) - 1, chunk):
+        M += np.bincount (n_id[i]*n_neu + n_id[j], \
+                          weights=np.exp(-(ts[j]-ts[i])**2/(4*sigma**2)), \
+                          minlength=n_neu*n_neu)
+    M = M.reshape([n_neu,n_neu])
+    count = np.bincount(n_id, minlength=n_neu)
+    C = A*(M + M.T + np.diag(count))
+    S = np.sqrt(2*np.pi)*sigma/dt * count
+
+    Z = None
+    if teach_sig is not None:
+        teach_sig = np.asarray(teach_sig).reshape([nT,-1])
+        radius = Gaussian(sigma).radius(tol)
+        lo  = np.searchsorted (t, ts - radius, side='left')
+        cnt = np.searchsorted (t, ts + radius, side='right') - lo
+        Z   = np.zeros ([n_neu, teach_sig.shape[1]])
+        for spk, rows in _window_rows (lo, cnt, chunk):
+            W    = sparse.coo_matrix ((np.exp(-(t[rows]-ts[spk])**2/(2*sigma**2)), \
+                                       (n_id[spk], rows)), shape=(n_neu, nT))
+            Z   += W.tocsr().dot(teach_sig)
+    return C, Z, nT, S